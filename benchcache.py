@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the speed of the SimpleCache and SQLiteCache cache backends, and
+# check SQLiteCache is shared between processes
+
+import multiprocessing, os, sys, tempfile, time
+
+from werkzeug.contrib.cache import SimpleCache
+
+from ospfm.cache import SQLiteCache
+
+OPERATIONS = 10000
+PROCESSES = 4
+
+def measure(name, function):
+    start = time.time()
+    for i in xrange(OPERATIONS):
+        function(i)
+    duration = time.time() - start
+    print '  {0:<6} {1:>10.0f} operations/s'.format(name,
+                                                     OPERATIONS / duration)
+
+def benchmark(cache):
+    print cache.__class__.__name__
+    measure('set', lambda i: cache.set('key-{0}'.format(i % 100), i, 60))
+    measure('get', lambda i: cache.get('key-{0}'.format(i % 100)))
+    measure('inc', lambda i: cache.inc('counter'))
+    measure('add', lambda i: cache.add('added-{0}'.format(i % 100), i, 60))
+
+def increment(cache):
+    for i in xrange(OPERATIONS / PROCESSES):
+        cache.inc('shared')
+
+def shared(cache):
+    processes = [multiprocessing.Process(target=increment, args=(cache,))
+                 for i in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print '  {0} increments in {1} processes: counter is {2}'.format(
+                OPERATIONS, PROCESSES, cache.get('shared')
+          )
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        OPERATIONS = int(sys.argv[1])
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'cache.sqlite3')
+    try:
+        for cache in (SimpleCache(), SQLiteCache(path)):
+            benchmark(cache)
+            shared(cache)
+    finally:
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime, sys
+
+from ospfm import helpers
+from ospfm.core import exchangerate, models as core
+from ospfm.transaction import models as transaction
+
+def rebuild_balances():
+    """Recompute the stored accounts and total balances"""
+    transaction.rebuild_account_balances()
+
+def rebuild_categories():
+    """Recompute the categories closure and daily balances"""
+    transaction.rebuild_category_closure()
+    transaction.rebuild_category_daily_balances()
+
+def rebuild_search():
+    """Recompute the full-text search index of transactions"""
+    transaction.rebuild_transaction_words()
+
+def rebuild_users():
+    """Recompute the users search index"""
+    core.rebuild_user_trigrams()
+
+def refresh_rates():
+    """Store the latest exchange rates from the rates provider"""
+    exchangerate.refresh()
+
+def backfill_rates(fromdate='', todate=None):
+    """Store the exchange rates of past days (dates as YYYY-MM-DD)"""
+    fromday = helpers.date_from_string(fromdate)
+    if todate:
+        today = helpers.date_from_string(todate)
+    else:
+        today = datetime.date.today()
+    if not fromday or not today or fromday > today:
+        print 'Usage: {0} backfill-rates <first day> [<last day>]'.format(
+                                                                sys.argv[0])
+        print 'Days are YYYY-MM-DD, the last day defaults to today'
+        sys.exit(1)
+    missing = exchangerate.backfill(fromday, today)
+    if missing:
+        print 'The rates provider has no rates for {0} day(s)'.format(missing)
+        print '(a local rates file, EXCHANGE_RATES_FILE, has no history)'
+        sys.exit(1)
+
+commands = {
+    'rebuild-balances': rebuild_balances,
+    'rebuild-categories': rebuild_categories,
+    'rebuild-search': rebuild_search,
+    'rebuild-users': rebuild_users,
+    'refresh-rates': refresh_rates,
+    'backfill-rates': backfill_rates,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print 'Usage: {0} <command>'.format(sys.argv[0])
+        print 'Available commands: {0}'.format(', '.join(sorted(commands)))
+        sys.exit(1)
+    commands[sys.argv[1]](*sys.argv[2:])
@@ -15,17 +15,28 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-import uuid
-
-from passlib.hash import sha512_crypt
+import base64, hashlib, hmac, os, time, uuid
 
 from flask import abort, jsonify, request
+from werkzeug.security import safe_str_cmp
 
-from ospfm import config
+from ospfm import config, db, passwords
 from ospfm.core import models as core
 
 cache = config.CACHE
 
+# If set, API keys are signed instead of being stored in the cache
+API_KEY_SECRET = getattr(config, 'API_KEY_SECRET', None)
+API_KEY_DURATION = 3600
+# Revoked signed API keys are reloaded from the database after this duration
+REVOCATIONS_RELOAD = 60
+revocations = {'loaded': 0, 'signatures': set()}
+
+REFRESH_TOKEN_SECRET = getattr(config, 'REFRESH_TOKEN_SECRET', '')
+# Refresh tokens expire when they are not used during this duration (seconds)
+REFRESH_TOKEN_DURATION = getattr(config, 'REFRESH_TOKEN_DURATION',
+                                 90 * 24 * 3600)
+
 # First, authenticate the user with a username and password
 # Next, authenticate API access with an API key, which is valid during 1 hour
 # API keys are UUIDs v4. UUIDs v4 collision is very unlikely, so we may rely
@@ -45,6 +56,17 @@ cache = config.CACHE
 # with it.
 #
 # Moving to a database storage is not excluded.
+#
+# With multiple workers (or servers), the cache must be shared... or API keys
+# must be signed, with API_KEY_SECRET: a signed API key contains the username
+# and its expiration time, its signature includes the remote IP address. Any
+# worker checks it locally: only revoked keys (on logout) are read from the
+# database, at most every REVOCATIONS_RELOAD seconds.
+#
+# To avoid sending the password again (and verifying its hash, which is slow
+# on purpose), a user interface may ask for a refresh token on login, by giving
+# a "device" name. The refresh token gives new API keys until it is revoked or
+# unused during REFRESH_TOKEN_DURATION.
 
 def authenticate(username=None, password=None, http_abort=True):
     if not username:
@@ -73,12 +95,16 @@ def authenticate(username=None, password=None, http_abort=True):
             # self.forbidden('Wrong username or password')
         else:
             return False
-    if sha512_crypt.verify(password, user.passhash):
+    if passwords.check_password(password, user.passhash):
         # Last login was not a fail, remove the fail info in the cache
         cache.delete(request.remote_addr+'-'+username+'-authfails')
-        key = str(uuid.uuid4())
-        cache.set(request.remote_addr+'---'+key, username, 3600)
-        return jsonify(status=200, response={'key': key})
+        response = {'key': new_key(username)}
+        if http_abort and request.values.get('device'):
+            response['refresh_token'] = create_refresh_token(
+                                            username,
+                                            request.values['device']
+                                        )
+        return jsonify(status=200, response=response)
     elif http_abort:
         # Minimal protection against passwords guess attempts: each login
         # failure increments this counter
@@ -87,9 +113,159 @@ def authenticate(username=None, password=None, http_abort=True):
     else:
         return False
 
+def new_key(username):
+    """Create a new API key for the user, valid during 1 hour"""
+    if API_KEY_SECRET:
+        expiry = int(time.time()) + API_KEY_DURATION
+        encodedusername = base64.urlsafe_b64encode(username.encode('utf8'))
+        return '{0}.{1}.{2}'.format(encodedusername.rstrip('='), expiry,
+                                    key_signature(username, expiry))
+    key = str(uuid.uuid4())
+    cache.set(request.remote_addr+'---'+key, username, API_KEY_DURATION)
+    return key
+
+def key_signature(username, expiry):
+    return hmac.new(
+                API_KEY_SECRET,
+                '{0}|{1}|{2}'.format(username.encode('utf8'), expiry,
+                                     request.remote_addr),
+                hashlib.sha256
+           ).hexdigest()
+
+def parse_signed_key(key):
+    """Return the (username, expiry, signature) of a signed API key, or None"""
+    try:
+        username, expiry, signature = str(key).split('.')
+        username = base64.urlsafe_b64decode(
+                        username + '=' * (-len(username) % 4)
+                   ).decode('utf8')
+        return username, int(expiry), signature
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+def revoked_signatures():
+    """Return the signatures of revoked API keys (reloaded regularly)"""
+    now = int(time.time())
+    if now - revocations['loaded'] > REVOCATIONS_RELOAD:
+        revocations['signatures'] = set([
+            r.signature for r in db.session.query(
+                core.RevokedApiKey.signature
+            ).filter(core.RevokedApiKey.expiry >= now)
+        ])
+        revocations['loaded'] = now
+    return revocations['signatures']
+
+def signed_key_username(key):
+    """Return the username of a valid signed API key, or None"""
+    parsed = parse_signed_key(key)
+    if not parsed:
+        return None
+    username, expiry, signature = parsed
+    if expiry < time.time() or \
+       not safe_str_cmp(signature, key_signature(username, expiry)) or \
+       signature in revoked_signatures():
+        return None
+    return username
+
+def logout():
+    """Revoke the API key"""
+    key = request.values.get('key', None)
+    get_username_auth(key)
+    parsed = API_KEY_SECRET and key and parse_signed_key(key)
+    if parsed:
+        username, expiry, signature = parsed
+        now = int(time.time())
+        core.RevokedApiKey.query.filter(
+            core.RevokedApiKey.expiry < now
+        ).delete()
+        if not core.RevokedApiKey.query.get(signature):
+            db.session.add(core.RevokedApiKey(signature=signature,
+                                              expiry=expiry))
+        db.session.commit()
+        revocations['signatures'].add(signature)
+    elif key:
+        cache.delete(request.remote_addr+'---'+key)
+    return jsonify(status=200, response='OK Logged out')
+
+def secret_hmac(secret):
+    return hmac.new(REFRESH_TOKEN_SECRET, secret, hashlib.sha256).hexdigest()
+
+def create_refresh_token(username, device):
+    """Create a refresh token for a device of the user"""
+    secret = os.urandom(24).encode('hex')
+    now = int(time.time())
+    token = core.RefreshToken(
+        user_username = username,
+        device = device[:100],
+        secret_hmac = secret_hmac(secret),
+        created = now,
+        last_used = now
+    )
+    db.session.add(token)
+    db.session.commit()
+    return '{0}.{1}'.format(token.id, secret)
+
+def refresh():
+    """Create a new API key from a refresh token"""
+    try:
+        tokenid, secret = request.values['token'].encode('utf8').split('.')
+        tokenid = int(tokenid)
+    except (KeyError, ValueError):
+        abort(401, 'Wrong refresh token')
+    token = core.RefreshToken.query.get(tokenid)
+    now = int(time.time())
+    if not token or token.revoked or \
+       token.last_used + REFRESH_TOKEN_DURATION < now or \
+       not safe_str_cmp(token.secret_hmac, secret_hmac(secret)):
+        abort(401, 'Wrong refresh token')
+    token.last_used = now
+    db.session.commit()
+    return jsonify(status=200,
+                   response={'key': new_key(token.user_username)})
+
+def refresh_tokens():
+    """List the valid refresh tokens of the user"""
+    username = get_username_auth(request.values.get('key', None))
+    tokens = core.RefreshToken.query.filter(
+                db.and_(
+                    core.RefreshToken.user_username == username,
+                    core.RefreshToken.revoked == False,
+                    core.RefreshToken.last_used >= \
+                                    int(time.time()) - REFRESH_TOKEN_DURATION
+                )
+             ).order_by(core.RefreshToken.last_used.desc())
+    return jsonify(status=200, response=[t.as_dict() for t in tokens])
+
+def revoke_refresh_token(tokenid):
+    """Revoke a refresh token of the user"""
+    username = get_username_auth(request.values.get('key', None))
+    token = core.RefreshToken.query.filter(
+                db.and_(
+                    core.RefreshToken.user_username == username,
+                    core.RefreshToken.id == tokenid
+                )
+            ).first()
+    if not token:
+        abort(404, 'This refresh token does not exist')
+    token.revoked = True
+    db.session.commit()
+    return jsonify(status=200, response='OK Revoked')
+
+def revoke_user_refresh_tokens(username):
+    """Revoke all refresh tokens of a user (committed by the caller)"""
+    core.RefreshToken.query.filter(
+        db.and_(
+            core.RefreshToken.user_username == username,
+            core.RefreshToken.revoked == False
+        )
+    ).update({'revoked': True}, synchronize_session=False)
+
 def get_username_auth(key):
         if key:
-            username = cache.get(request.remote_addr+'---'+key)
+            if API_KEY_SECRET and '.' in key:
+                username = signed_key_username(key)
+            else:
+                username = cache.get(request.remote_addr+'---'+key)
             if username:
                 return username
         if config.DEVEL and config.DEVEL_USERNAME:
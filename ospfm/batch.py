@@ -0,0 +1,108 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from flask import abort, request
+
+from sqlalchemy.exc import StatementError
+from werkzeug.exceptions import HTTPException
+
+from ospfm import app, authentication, db
+from ospfm.core import models as coremodels
+from ospfm.objects import Object
+from ospfm.transaction.account import Account
+from ospfm.transaction.category import Category
+from ospfm.transaction.transaction import Transaction
+
+objects = {
+    'accounts': Account,
+    'categories': Category,
+    'transactions': Transaction
+}
+
+
+def operation_args(args):
+    """
+    Convert the arguments of an operation to the format of HTTP requests
+    arguments : lists and dictionaries are JSON-encoded, other values are
+    converted to strings
+    """
+    converted = {}
+    for name, value in args.items():
+        if isinstance(value, (list, dict)):
+            converted[name] = json.dumps(value)
+        elif isinstance(value, bool):
+            converted[name] = unicode(value).lower()
+        else:
+            converted[name] = unicode(value)
+    return converted
+
+def execute(username, operation):
+    """Execute one operation, without committing it"""
+    if not isinstance(operation, dict) or \
+       operation.get('object') not in objects or \
+       operation.get('method') not in ('create', 'update', 'delete'):
+        abort(400, 'Unknown operation')
+    args = operation.get('args', {})
+    if not isinstance(args, dict):
+        abort(400, 'Operation arguments must be a dictionary')
+    obj = objects[operation['object']](**operation_args(args))
+    obj.username = username
+    obj.batch = True
+    if operation['method'] == 'create':
+        response = obj.create()
+    elif operation['method'] == 'update':
+        response = obj.update(operation.get('id'))
+    else:
+        obj.delete(operation.get('id'))
+        response = 'OK Deleted'
+    return response, obj.add_data
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Execute multiple operations in a single database transaction: either
+    all operations succeed, or none
+    """
+    args = request.values.to_dict()
+    username = authentication.get_username_auth(args.get('key', None))
+    try:
+        operations = json.loads(args['operations'])
+    except (KeyError, ValueError):
+        abort(400, 'Please provide the operations')
+    if not isinstance(operations, list):
+        abort(400, 'Operations must be a list')
+    results = []
+    coremodels.bump_data_version(username)
+    container = Object()
+    container.username = username
+    for index, operation in enumerate(operations):
+        try:
+            response, add_data = execute(username, operation)
+        except HTTPException, e:
+            db.session.rollback()
+            abort(e.code, u'Operation {0}: {1}'.format(index, e.description))
+        except StatementError:
+            db.session.rollback()
+            abort(400, 'Operation {0}: Database error'.format(index))
+        results.append(response)
+        for data in add_data:
+            container.add_to_response(*data)
+    db.session.commit()
+    # Additional data is created once for the whole batch
+    return container._Object__response(results)
@@ -0,0 +1,354 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import stat
+import threading
+import time
+from collections import OrderedDict
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+
+from werkzeug.contrib.cache import BaseCache, NullCache, SimpleCache
+
+# Cache backends, to be used as config.CACHE
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache stored in a SQLite database (in WAL mode), shared by all processes
+    of a host without any external service
+
+    Each thread of each process uses its own connection. Values are pickled,
+    "add", "inc" and "dec" are atomic between processes.
+
+    As unpickling runs arbitrary code, nobody but the user running OSPFM may
+    write the database: it must be in a directory owned by this user and not
+    writable by others (not in /tmp). This is checked when the cache is
+    created.
+    """
+
+    # Expired entries are removed every PRUNE_INTERVAL writes (in each process)
+    PRUNE_INTERVAL = 500
+
+    def __init__(self, path, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.__check_permissions()
+        self.local = threading.local()
+        self.writes = 0
+        self.__connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)'
+        )
+
+    def __check_permissions(self):
+        uid = os.getuid()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        status = os.stat(directory)
+        if status.st_uid != uid or status.st_mode & (stat.S_IWGRP |
+                                                     stat.S_IWOTH):
+            raise ValueError(
+                'Cache directory {0} must be owned by the current user and '
+                'not writable by others'.format(directory)
+            )
+        # The database itself, and its WAL files
+        for suffix in ('', '-wal', '-shm'):
+            filename = self.path + suffix
+            if os.path.exists(filename) and os.stat(filename).st_uid != uid:
+                raise ValueError(
+                    'Cache file {0} must be owned by the current '
+                    'user'.format(filename)
+                )
+
+    def __connection(self):
+        # Connections cannot be shared between threads, nor after a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def __transaction(self):
+        return Transaction(self.__connection())
+
+    def __expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if not timeout:
+            return None
+        return time.time() + timeout
+
+    def __prune(self, connection):
+        self.writes += 1
+        if self.writes % self.PRUNE_INTERVAL == 0:
+            connection.execute('DELETE FROM cache WHERE expires < ?',
+                               (time.time(),))
+
+    def __read(self, connection, key):
+        """Return the (value, expiration time) of an entry, or None"""
+        row = connection.execute(
+            'SELECT value, expires FROM cache WHERE key = ? AND '
+            '(expires IS NULL OR expires >= ?)',
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return loads(str(row[0])), row[1]
+
+    def __write(self, connection, key, value, timeout):
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) '
+            'VALUES (?, ?, ?)',
+            (key, sqlite3.Binary(dumps(value, HIGHEST_PROTOCOL)),
+             self.__expires(timeout))
+        )
+        self.__prune(connection)
+
+    def get(self, key):
+        # In WAL mode, readers are never blocked
+        entry = self.__read(self.__connection(), key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def set(self, key, value, timeout=None):
+        with self.__transaction() as connection:
+            self.__write(connection, key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        with self.__transaction() as connection:
+            if self.__read(connection, key) is not None:
+                return False
+            self.__write(connection, key, value, timeout)
+            return True
+
+    def delete(self, key):
+        with self.__transaction() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def inc(self, key, delta=1):
+        with self.__transaction() as connection:
+            entry = self.__read(connection, key)
+            if entry is None:
+                value, timeout = delta, None
+            else:
+                # Keep the expiration time of the entry
+                value = entry[0] + delta
+                if entry[1] is None:
+                    timeout = 0
+                else:
+                    timeout = max(entry[1] - time.time(), 0.001)
+            self.__write(connection, key, value, timeout)
+            return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def clear(self):
+        with self.__transaction() as connection:
+            connection.execute('DELETE FROM cache')
+
+
+class Transaction(object):
+    """
+    Immediate SQLite transaction: the database is locked for writing from the
+    start, so a read followed by a write is atomic
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+
+# Namespaces of statistics: keys are either one of these names or one of them
+# followed by "-" and variable parts (ids, usernames, versions)
+NAMESPACES = (
+    'categorybalance',
+    'categoryversion',
+    'currenciesversion',
+    'usercurrencies',
+    'open-exchange-rates',
+    'exchange-rates-count',
+    'exchange-rates-refresh',
+)
+
+def key_namespace(key):
+    """
+    Return the namespace of a key, for statistics: a fixed number of
+    namespaces, whatever the number of users
+    """
+    if '---' in key:
+        return 'apikey'
+    if key.endswith('-authfails'):
+        return 'authfails'
+    for namespace in NAMESPACES:
+        if key == namespace or key.startswith(namespace + '-'):
+            return namespace
+    return 'other'
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache limited to a size in bytes: when it is reached, the least
+    recently used entries are evicted
+
+    Values are pickled (their size is the size of their pickle). Hits, misses
+    and evictions are counted by namespace of keys.
+    """
+
+    # Approximate memory used by each entry, in addition to its key and value
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, max_bytes=16*1024*1024, default_timeout=300,
+                 namespace=key_namespace):
+        BaseCache.__init__(self, default_timeout)
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        # {<key>: (<pickled value>, <expiration time>, <size>)}, from the least
+        # recently used
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counters = {}
+
+    def __count(self, key, counter):
+        namespace = self.namespace(key)
+        if namespace not in self.counters:
+            self.counters[namespace] = {'hits': 0, 'misses': 0,
+                                        'evictions': 0}
+        self.counters[namespace][counter] += 1
+
+    def __expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if not timeout:
+            return None
+        return time.time() + timeout
+
+    def __remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def __read(self, key):
+        """Return the entry of a key (as recently used) or None, with the lock"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.__count(key, 'misses')
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            self.bytes -= entry[2]
+            self.__count(key, 'misses')
+            return None
+        self.entries[key] = entry
+        self.__count(key, 'hits')
+        return entry
+
+    def __store(self, key, pickled, expires):
+        """Store a pickled value and evict old entries, with the lock"""
+        self.__remove(key)
+        size = len(key) + len(pickled) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (pickled, expires, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            evictedkey, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted[2]
+            self.__count(evictedkey, 'evictions')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.__read(key)
+        if entry is None:
+            return None
+        return loads(entry[0])
+
+    def set(self, key, value, timeout=None):
+        pickled = dumps(value, HIGHEST_PROTOCOL)
+        with self.lock:
+            self.__store(key, pickled, self.__expires(timeout))
+
+    def add(self, key, value, timeout=None):
+        pickled = dumps(value, HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.__read(key) is not None:
+                return False
+            self.__store(key, pickled, self.__expires(timeout))
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.__remove(key)
+
+    def inc(self, key, delta=1):
+        with self.lock:
+            entry = self.__read(key)
+            if entry is None:
+                value, expires = delta, self.__expires(None)
+            else:
+                # Keep the expiration time of the entry
+                value, expires = loads(entry[0]) + delta, entry[1]
+            self.__store(key, dumps(value, HIGHEST_PROTOCOL), expires)
+            return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return the size of the cache and the counters of each namespace"""
+        with self.lock:
+            namespaces = {}
+            for namespace, counters in self.counters.items():
+                namespaces[namespace] = dict(counters)
+                requests = counters['hits'] + counters['misses']
+                namespaces[namespace]['hit_ratio'] = \
+                                requests and float(counters['hits']) / requests
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'namespaces': namespaces
+            }
+
+
+def is_shared(cache):
+    """
+    Return True if the cache is shared by all processes (SQLiteCache,
+    memcached, redis...): values set or deleted by a worker are seen by the
+    others. Values stored in a cache local to each process must only be kept
+    for a short time, as their invalidations are not seen by other workers.
+    """
+    return not isinstance(cache, (SimpleCache, NullCache, LRUCache))
@@ -24,6 +24,8 @@ from ospfm.objects import Object
 
 class Currency(Object):
 
+    cacheable = True
+
     def __own_currency(self, isocode):
         return models.Currency.query.filter(
             db.and_(
@@ -36,20 +38,15 @@ class Currency(Object):
         )
 
     def list(self):
-        currencies = models.Currency.query.filter(
-            db.or_(
-                models.Currency.owner_username == self.username,
-                models.Currency.owner_username == None,
-            )
-        )
-        return [c.as_dict() for c in currencies]
+        # Both lists are already serialized
+        return list(models.load_global_currencies()[1]) + \
+               list(models.user_currencies(self.username)[1])
 
     def create(self):
         # With user-defined currencies, isocode=symbol
         symbol = self.args['symbol']
 
-        currency_exists = self.__own_currency(symbol).all()
-        if currency_exists:
+        if models.find_currency(self.username, symbol):
             self.badrequest("A currency with this symbol already exists")
         c = models.Currency(
                 owner_username = self.username,
@@ -60,12 +57,13 @@ class Currency(Object):
         )
         db.session.add(c)
         db.session.commit()
+        helpers.forget_rates(self.username)
         return c.as_dict()
 
     def read(self, isocode):
-        currency = self.__own_currency(isocode).first()
+        currency = models.find_currency(self.username, isocode)
         if currency:
-            return currency.as_dict(with_rate=True)
+            return currency.as_dict()
         else:
             self.notfound('This currency does not exist')
 
@@ -79,8 +77,7 @@ class Currency(Object):
         if 'symbol' in self.args:
             # With user-defined currencies, isocode=symbol
             newsymbol = self.args['symbol']
-            testcurrency = self.__own_currency(newsymbol).first()
-            if not testcurrency:
+            if not models.find_currency(self.username, newsymbol):
                 currency.isocode = newsymbol
                 currency.symbol = newsymbol
         if 'name' in self.args:
@@ -89,6 +86,7 @@ class Currency(Object):
             currency.rate = self.args['rate']
             self.add_to_response('totalbalance')
         db.session.commit()
+        helpers.forget_rates(self.username)
         return currency.as_dict()
 
     def delete(self, isocode):
@@ -111,6 +109,7 @@ class Currency(Object):
                 self.badrequest("This currency is still in use")
         db.session.delete(currency)
         db.session.commit()
+        helpers.forget_rates(self.username)
 
     def http_rate(self, fromisocode, toisocode):
         response = helpers.rate(self.username, fromisocode, toisocode)
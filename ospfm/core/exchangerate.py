@@ -15,29 +15,349 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-import time
+import datetime
 import json
+import threading
+import time
 import urllib
+from array import array
+from bisect import bisect_right
 from decimal import Decimal
 
-from ospfm import config
+from flask import abort
+
+from ospfm import app, config, db
+from ospfm.core import models
 cache = config.CACHE
 
-OPEN_EXCHANGE_RATES_LATEST_VALUES_URL = (
-    'http://openexchangerates.org/api/latest.json?app_id={0}'.format(
-                                                   config.OPEN_EXCHANGE_APP_ID)
-)
+# Exchange rates are stored locally as snapshots (ExchangeRateSnapshot) and
+# "getrate" only reads the latest snapshot: requests never wait for the rates
+# provider, except when there is no snapshot at all yet.
+#
+# When the latest snapshot is older than REFRESH_INTERVAL, a background thread
+# asks the provider for new rates while the stale ones continue to be used.
+# The "refresh-rates" maintenance command may also be run periodically (with
+# cron, for instance).
+#
+# As one snapshot is kept per day, snapshots also are the history of rates,
+# used for conversions at a given date (see RatesHistory). Past days may be
+# imported with the "backfill-rates" maintenance command.
 
-def getrate(from_currency, to_currency, amount='1'):
-    rates = cache.get('open-exchange-rates')
-    if not rates:
-        exchanges_json = urllib.urlopen(OPEN_EXCHANGE_RATES_LATEST_VALUES_URL)
+# OpenExchangeRates updates its rates every hour
+REFRESH_INTERVAL = 3600
+# Time during which the latest snapshot is kept in the cache
+SNAPSHOT_CACHE_DURATION = 60
+# Time during which a refresh is considered in progress
+REFRESH_LOCK_DURATION = 60
+
+
+class Provider(object):
+    """Source of exchange rates"""
+
+    def latest(self):
+        """
+        Override this method to return the latest rates, in the following
+        format: (<timestamp>, <base isocode>, {<isocode>: <rate>, [...]})
+        """
+        raise NotImplementedError
+
+    def historical(self, day):
+        """
+        Override this method to return the rates at the end of the given day,
+        in the same format as "latest", or None if the provider has no rates
+        for this day
+        """
+        raise NotImplementedError
+
+
+class OpenExchangeRatesProvider(Provider):
+    LATEST_VALUES_URL = 'http://openexchangerates.org/api/latest.json?app_id={0}'
+    HISTORICAL_VALUES_URL = (
+        'http://openexchangerates.org/api/historical/{1}.json?app_id={0}'
+    )
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+
+    def __get(self, url):
+        exchanges_json = urllib.urlopen(url)
         rates = json.load(exchanges_json)
         exchanges_json.close()
-        # In order to have the most up-to-date rates from OpenExchangeRates,
-        # duration = 1 hour - (now - timestamp) + 10 seconds security window)
-        duration = 3600 - (int(time.time()) - rates['timestamp']) + 10
-        cache.set('open-exchange-rates', rates, duration)
+        return rates['timestamp'], rates['base'], rates['rates']
+
+    def latest(self):
+        return self.__get(self.LATEST_VALUES_URL.format(self.app_id))
+
+    def historical(self, day):
+        return self.__get(
+            self.HISTORICAL_VALUES_URL.format(self.app_id,
+                                              day.strftime('%Y-%m-%d'))
+        )
+
+
+class FileProvider(Provider):
+    """
+    Read rates from a local JSON file in the OpenExchangeRates format, for
+    offline use or tests
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def latest(self):
+        with open(self.path) as exchanges_json:
+            rates = json.load(exchanges_json)
+        return rates['timestamp'], rates['base'], rates['rates']
+
+    def historical(self, day):
+        # A single file has no history
+        return None
+
+
+def provider():
+    """Return the configured rates provider"""
+    ratesfile = getattr(config, 'EXCHANGE_RATES_FILE', None)
+    if ratesfile:
+        return FileProvider(ratesfile)
+    return OpenExchangeRatesProvider(config.OPEN_EXCHANGE_APP_ID)
+
+def store(timestamp, base, rates):
+    """Store rates as the snapshot of the day of their timestamp"""
+    day = datetime.datetime.utcfromtimestamp(timestamp).date()
+    snapshot = models.ExchangeRateSnapshot.query.filter(
+                    models.ExchangeRateSnapshot.day == day
+               ).first()
+    if not snapshot:
+        snapshot = models.ExchangeRateSnapshot(day=day, timestamp=0)
+        db.session.add(snapshot)
+    if snapshot.timestamp <= timestamp:
+        snapshot.timestamp = timestamp
+        snapshot.base = base
+        snapshot.rates = json.dumps(rates)
+    db.session.commit()
+    cache.delete('open-exchange-rates')
+    cache.delete('exchange-rates-count')
+
+def refresh():
+    """Get the latest rates from the provider and store them"""
+    store(*provider().latest())
+
+def refresh_thread(rates=None):
+    try:
+        with app.app_context():
+            try:
+                if rates:
+                    store(*rates)
+                else:
+                    refresh()
+            except Exception:
+                # The provider may be unreachable: stale rates will be used
+                # until the next attempt
+                db.session.rollback()
+                app.logger.exception('Exchange rates refresh failed')
+            finally:
+                db.session.remove()
+    finally:
+        cache.delete('exchange-rates-refresh')
+
+def refresh_in_background(rates=None):
+    """
+    Refresh the rates in a background thread, unless already running. If
+    "rates" are given (in the Provider.latest format), they are stored instead
+    of requesting the provider.
+    """
+    if cache.add('exchange-rates-refresh', True, REFRESH_LOCK_DURATION):
+        thread = threading.Thread(target=refresh_thread, args=(rates,))
+        thread.daemon = True
+        thread.start()
+
+def fetch():
+    """
+    Request the latest rates from the provider and return them as a snapshot
+    dictionary (or None if the provider failed). They are stored by a
+    background thread, as storing them commits the current database session.
+    """
+    try:
+        timestamp, base, rates = provider().latest()
+    except Exception:
+        app.logger.exception('Exchange rates request failed')
+        return None
+    refresh_in_background((timestamp, base, rates))
+    return {
+        'day': datetime.datetime.utcfromtimestamp(timestamp).date(),
+        'timestamp': timestamp,
+        'base': base,
+        'rates': rates
+    }
+
+def latest():
+    """
+    Return the latest snapshot as a dictionary, or None if there is no
+    snapshot and the provider cannot be reached
+    """
+    rates = cache.get('open-exchange-rates')
+    if not rates:
+        snapshot = models.ExchangeRateSnapshot.query.order_by(
+                        db.desc(models.ExchangeRateSnapshot.day)
+                   ).first()
+        if snapshot:
+            rates = snapshot.as_dict()
+        else:
+            # No rates at all yet (first run): they cannot be used stale
+            # while being requested, the request waits for the provider
+            rates = fetch()
+            if not rates:
+                return None
+        cache.set('open-exchange-rates', rates, SNAPSHOT_CACHE_DURATION)
+    if int(time.time()) - rates['timestamp'] > REFRESH_INTERVAL:
+        # Stale rates are still used while new ones are requested
+        refresh_in_background()
+    return rates
+
+def backfill(fromday, today):
+    """
+    Store the rates of all days between both dates which have no snapshot,
+    return the number of days the provider had no rates for
+    """
+    rates_provider = provider()
+    known_days = set([
+        s.day for s in db.session.query(models.ExchangeRateSnapshot.day)
+    ])
+    missing = 0
+    day = fromday
+    while day <= today:
+        if day not in known_days:
+            rates = rates_provider.historical(day)
+            if rates:
+                store(*rates)
+            else:
+                missing += 1
+        day = day + datetime.timedelta(1)
+    return missing
+
+
+class RatesHistory(object):
+    """
+    Daily exchange rates of all currencies
+
+    Days are stored as a sorted array of ordinals and, for each currency, rates
+    are stored in an array aligned on the days: the rates of a date are found
+    by a binary search on the days. Days with no snapshot use the rates of the
+    previous snapshot, dates before the first snapshot use the first one.
+    """
+
+    def __init__(self, snapshots):
+        """"snapshots" is a list of (<date>, {<isocode>: <rate>}), by date"""
+        self.days = array('l')
+        self.rates = {}
+        for index, (day, rates) in enumerate(snapshots):
+            self.days.append(day.toordinal())
+            for isocode, rate in rates.items():
+                if isocode not in self.rates:
+                    # Unknown until now: use the first known rate before
+                    self.rates[isocode] = array('d', [rate] * index)
+                self.rates[isocode].append(rate)
+            for isocode, currencyrates in self.rates.items():
+                if len(currencyrates) == index:
+                    # Missing from this snapshot: keep the previous rate
+                    currencyrates.append(currencyrates[-1])
+
+    def index(self, day):
+        """Return the index of the rates to use for a date"""
+        return max(bisect_right(self.days, day.toordinal()) - 1, 0)
+
+    def __ratio(self, index, from_currency, to_currency):
+        if from_currency == to_currency:
+            return Decimal(1)
+        if not self.days or from_currency not in self.rates or \
+           to_currency not in self.rates:
+            return None
+        # Using "Decimal(str(<value>))" in order to get exact results
+        base_to_from = Decimal(str(self.rates[from_currency][index]))
+        base_to_to = Decimal(str(self.rates[to_currency][index]))
+        return base_to_to / base_to_from
+
+    def rate(self, from_currency, to_currency, day):
+        """Return the rate between two currencies at a given date"""
+        return self.__ratio(self.index(day), from_currency, to_currency)
+
+    def convert(self, entries, to_currency):
+        """
+        Convert many amounts at once, at the rates of their dates
+
+        "entries" is an iterable of (<date>, <amount>, <currency isocode>),
+        the result is the list of converted amounts (None if a currency is
+        unknown). Each rate is calculated only once per day and currency.
+        """
+        ratios = {}
+        converted = []
+        for day, amount, from_currency in entries:
+            key = (self.index(day), from_currency)
+            if key not in ratios:
+                ratios[key] = self.__ratio(key[0], from_currency, to_currency)
+            if ratios[key] is None:
+                converted.append(None)
+            else:
+                converted.append(Decimal(str(amount)) * ratios[key])
+        return converted
+
+loaded_history = {'version': None, 'history': None}
+history_lock = threading.Lock()
+
+def snapshots_count():
+    """Return the number of stored snapshots"""
+    count = cache.get('exchange-rates-count')
+    if count is None:
+        count = models.ExchangeRateSnapshot.query.count()
+        cache.set('exchange-rates-count', count, SNAPSHOT_CACHE_DURATION)
+    return count
+
+def history():
+    """
+    Return the rates history, loaded again after each new snapshot (latest
+    rates or backfilled days)
+    """
+    current = latest()
+    version = (current and current['timestamp'], snapshots_count())
+    with history_lock:
+        if loaded_history['history'] is None or \
+           loaded_history['version'] != version:
+            snapshots = models.ExchangeRateSnapshot.query.order_by(
+                            models.ExchangeRateSnapshot.day
+                        )
+            loaded_history['history'] = RatesHistory([
+                (s.day, json.loads(s.rates)) for s in snapshots
+            ])
+            loaded_history['version'] = version
+        return loaded_history['history']
+
+def version():
+    """Return the version of exchange rates (timestamp of the latest ones)"""
+    rates = latest()
+    return rates and rates['timestamp'] or 0
+
+def getrate(from_currency, to_currency, amount='1', day=None):
+    """
+    Return the rate between two globally defined currencies, multiplied by
+    "amount", at the given date (or the latest known rate), or None if one of
+    the currencies is unknown to the rates provider
+
+    If no rates are available at all, the request is aborted (error 503).
+    """
+    rates = latest()
+    if not rates:
+        abort(503, 'Exchange rates are not available, please try again later')
+    if day is not None and day < datetime.date.today():
+        ratehistory = history()
+        # Without stored snapshots yet, the latest rates are used
+        if ratehistory.days:
+            rate = ratehistory.rate(from_currency, to_currency, day)
+            if rate is None:
+                return None
+            return rate * Decimal(str(amount))
+    if from_currency not in rates['rates'] or \
+       to_currency not in rates['rates']:
+        return None
     # Using "Decimal(str(<value>))" in order to get exact results
     base_to_from = Decimal(str(rates['rates'][from_currency]))
     base_to_to = Decimal(str(rates['rates'][to_currency]))
@@ -15,9 +15,18 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import time
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.schema import UniqueConstraint
 
-from ospfm import db
+from ospfm import config, db
+from ospfm.cache import is_shared
+
+cache = config.CACHE
 
 
 
@@ -38,6 +47,20 @@ class Currency(db.Model):
                         self.name, self.isocode, self.symbol, self.rate
                     )
 
+    def info(self):
+        return CurrencyInfo(self.id, self.isocode, self.symbol, self.name,
+                            self.rate, self.owner_username)
+
+    def as_dict(self):
+        return self.info().as_dict()
+
+
+class CurrencyInfo(namedtuple('CurrencyInfo', ('id', 'isocode', 'symbol',
+                                               'name', 'rate',
+                                               'owner_username'))):
+    """Read-only copy of a currency, which may be kept between requests"""
+    __slots__ = ()
+
     def as_dict(self):
         info = {
             'isocode': self.isocode,
@@ -51,6 +74,89 @@ class Currency(db.Model):
         return info
 
 
+# Globally defined currencies rarely change: they are loaded by each process,
+# with their serialized list, and loaded again after GLOBAL_CURRENCIES_DURATION
+# or when an unknown isocode is requested (at most once every
+# GLOBAL_CURRENCIES_RELOAD seconds). User-defined currencies are cached for
+# each user, until they are modified (or only for a short time if the cache is
+# local to each process, as other workers do not see their modifications).
+
+GLOBAL_CURRENCIES_DURATION = 3600
+GLOBAL_CURRENCIES_RELOAD = 10
+if is_shared(cache):
+    USER_CURRENCIES_CACHE_DURATION = 3600
+else:
+    USER_CURRENCIES_CACHE_DURATION = 60
+
+# {'loaded': (<load time>, {<isocode>: <CurrencyInfo>}, <serialized list>)}
+global_currencies = {}
+
+def load_global_currencies(reload=False):
+    """
+    Return the ({<isocode>: <CurrencyInfo>}, <serialized list>) of globally
+    defined currencies. If "reload" is True, they are loaded again unless
+    they have just been loaded.
+    """
+    now = time.time()
+    loaded = global_currencies.get('loaded')
+    if loaded is None or now - loaded[0] > GLOBAL_CURRENCIES_DURATION or \
+       (reload and now - loaded[0] > GLOBAL_CURRENCIES_RELOAD):
+        currencies = [c.info() for c in Currency.query.filter(
+                          Currency.owner_username == None
+                      ).order_by(Currency.id)]
+        loaded = (
+            now,
+            dict([(c.isocode, c) for c in currencies]),
+            tuple([c.as_dict() for c in currencies])
+        )
+        global_currencies['loaded'] = loaded
+    return loaded[1:]
+
+def global_currency(isocode):
+    """Return the CurrencyInfo of a globally defined currency, or None"""
+    currency = load_global_currencies()[0].get(isocode)
+    if currency is None:
+        # May have been added since they were loaded
+        currency = load_global_currencies(reload=True)[0].get(isocode)
+    return currency
+
+def user_currencies(username):
+    """
+    Return the ({<isocode>: <CurrencyInfo>}, <serialized list>) of the
+    user-defined currencies of a user
+    """
+    key = u'usercurrencies-{0}'.format(username)
+    currencies = cache.get(key)
+    if currencies is None:
+        infos = [c.info() for c in Currency.query.filter(
+                     Currency.owner_username == username
+                 ).order_by(Currency.id)]
+        currencies = (
+            dict([(c.isocode, c) for c in infos]),
+            tuple([c.as_dict() for c in infos])
+        )
+        cache.set(key, currencies, USER_CURRENCIES_CACHE_DURATION)
+    return currencies
+
+def forget_user_currencies(username):
+    """Forget the cached currencies of a user, after a change"""
+    cache.delete(u'usercurrencies-{0}'.format(username))
+
+def find_currency(username, isocode):
+    """
+    Return the CurrencyInfo of a currency the user can use (user-defined or
+    globally defined), or None
+    """
+    currency = user_currencies(username)[0].get(isocode) or \
+               global_currency(isocode)
+    if currency is None and not is_shared(cache):
+        # May have been created by another worker, which could not forget the
+        # currencies cached by this one
+        forget_user_currencies(username)
+        currency = user_currencies(username)[0].get(isocode)
+    return currency
+
+
 
 class User(db.Model):
     username              = db.Column(db.String(50), nullable=False,
@@ -60,6 +166,13 @@ class User(db.Model):
     passhash              = db.Column(db.String(120), nullable=False)
     preferred_currency_id = db.Column(db.ForeignKey('currency.id'),
                                       nullable=False)
+    # Incremented on each modification of the user's data
+    data_version          = db.Column(db.Integer, default=0, nullable=False)
+    # Total balance of the user's accounts in the preferred currency, with
+    # the exchange rates version it was computed with (NULL when it must be
+    # computed again, see ospfm.transaction.models)
+    total_balance         = db.Column(db.Numeric(15, 3))
+    total_balance_rates   = db.Column(db.Integer)
 
     preferred_currency = db.relationship(
                           'Currency',
@@ -86,6 +199,138 @@ class User(db.Model):
 
 
 
+def data_version(username):
+    """Return the version of the user's data"""
+    return db.session.query(User.data_version).filter(
+                User.username == username
+           ).scalar() or 0
+
+def bump_data_version(username):
+    """
+    Increment the version of the user's data : it is committed with the
+    modifications of the data
+    """
+    user = User.__table__
+    db.session.execute(
+        user.update().where(
+            user.c.username == username
+        ).values(
+            data_version = user.c.data_version + 1
+        )
+    )
+
+
+
+class UserTrigram(db.Model):
+    """
+    Trigrams (3 characters sequences) of the username, first and last names of
+    users, used to search users on parts of their names with an index
+    """
+    user_username = db.Column(db.ForeignKey('user.username',
+                                            onupdate='CASCADE',
+                                            ondelete='CASCADE'),
+                              primary_key=True)
+    trigram       = db.Column(db.String(3), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_user_trigram_trigram', 'trigram', 'user_username'),
+    )
+
+
+def trigrams(text):
+    """Return the distinct lowercase trigrams of a text"""
+    text = text.lower()
+    return set([text[i:i+3] for i in range(len(text) - 2)])
+
+def user_trigrams(username, first_name, last_name):
+    """Return the UserTrigram rows of a user"""
+    return [
+        {'user_username': username, 'trigram': trigram}
+        for trigram in trigrams(username) | trigrams(first_name or '') | \
+                       trigrams(last_name or '')
+    ]
+
+def index_user(connection, user, previous_username=None):
+    table = UserTrigram.__table__
+    if previous_username:
+        connection.execute(
+            table.delete().where(table.c.user_username == previous_username)
+        )
+    rows = user_trigrams(user.username, user.first_name, user.last_name)
+    if rows:
+        connection.execute(table.insert(), rows)
+
+@event.listens_for(User, 'after_insert')
+def user_inserted(mapper, connection, target):
+    index_user(connection, target)
+
+@event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, target):
+    usernames = get_history(target, 'username')
+    if usernames.has_changes() or \
+       get_history(target, 'first_name').has_changes() or \
+       get_history(target, 'last_name').has_changes():
+        previous_username = (usernames.deleted or [target.username])[0]
+        index_user(connection, target, previous_username)
+
+@event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, target):
+    table = UserTrigram.__table__
+    connection.execute(
+        table.delete().where(table.c.user_username == target.username)
+    )
+
+def search_users(substring):
+    """
+    Query users whose username, first or last name contain the substring (at
+    least 3 characters): candidates are found with the trigrams index, then
+    checked ; exact usernames come first, then names starting with the
+    substring
+    """
+    substringtrigrams = trigrams(substring)
+    candidates = db.select([UserTrigram.user_username]).where(
+                    UserTrigram.trigram.in_(substringtrigrams)
+                 ).group_by(
+                    UserTrigram.user_username
+                 ).having(
+                    db.func.count(UserTrigram.trigram) == len(substringtrigrams)
+                 )
+    contains = u'%{0}%'.format(substring)
+    startswith = u'{0}%'.format(substring)
+    return User.query.filter(
+                db.and_(
+                    User.username.in_(candidates),
+                    db.or_(
+                        User.username.like(contains),
+                        User.first_name.like(contains),
+                        User.last_name.like(contains)
+                    )
+                )
+           ).order_by(
+                db.case([
+                    (User.username == substring, 0),
+                    (db.or_(
+                        User.username.like(startswith),
+                        User.first_name.like(startswith),
+                        User.last_name.like(startswith)
+                     ), 1)
+                ], else_=2),
+                User.username
+           )
+
+def rebuild_user_trigrams():
+    """Recompute the trigrams of all users from scratch"""
+    db.session.execute(UserTrigram.__table__.delete())
+    rows = []
+    for username, first_name, last_name in db.session.query(
+                User.username, User.first_name, User.last_name):
+        rows.extend(user_trigrams(username, first_name, last_name))
+    if rows:
+        db.session.execute(UserTrigram.__table__.insert(), rows)
+    db.session.commit()
+
+
+
 class UserContact(db.Model):
     id               = db.Column(db.Integer, primary_key=True)
     user_username    = db.Column(db.ForeignKey('user.username',
@@ -124,7 +369,8 @@ class UserEmail(db.Model):
                                             onupdate='CASCADE',
                                             ondelete='CASCADE'),
                               nullable=False)
-    email_address = db.Column(db.String(256), nullable=False)
+    # Indexed for exact searches of users by email address
+    email_address = db.Column(db.String(256), nullable=False, index=True)
     # Notification is to be used by (an)other process(es), OSPFM itself doesn't
     # send notifications. This field make it possible to know which email
     # addresses should be used by this/these other process(es).
@@ -147,6 +393,50 @@ class UserEmail(db.Model):
 
 
 
+class RefreshToken(db.Model):
+    """
+    Long-lived token of a device, used to get new API keys without sending the
+    password again
+
+    Only a HMAC of the secret part of the token is stored.
+    """
+    id            = db.Column(db.Integer, primary_key=True)
+    user_username = db.Column(db.ForeignKey('user.username',
+                                            onupdate='CASCADE',
+                                            ondelete='CASCADE'),
+                              nullable=False, index=True)
+    device        = db.Column(db.String(100), nullable=False)
+    secret_hmac   = db.Column(db.String(64), nullable=False)
+    # Timestamps (seconds since epoch, UTC)
+    created       = db.Column(db.Integer, nullable=False)
+    last_used     = db.Column(db.Integer, nullable=False)
+    revoked       = db.Column(db.Boolean, nullable=False, default=False)
+
+    user = db.relationship('User', backref=db.backref('refresh_tokens'))
+
+    def __unicode__(self):
+        return u'Refresh token {0} of "{1}" on "{2}"'.format(
+                    self.id, self.user_username, self.device
+                )
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'device': self.device,
+            'created': self.created,
+            'last_used': self.last_used
+        }
+
+
+
+class RevokedApiKey(db.Model):
+    """Signature of a revoked signed API key, kept until the key expires"""
+    signature = db.Column(db.String(64), primary_key=True)
+    # Timestamp (seconds since epoch, UTC)
+    expiry    = db.Column(db.Integer, nullable=False, index=True)
+
+
+
 class UserPreference(db.Model):
     id            = db.Column(db.Integer, primary_key=True)
     user_username = db.Column(db.ForeignKey('user.username',
@@ -170,3 +460,32 @@ class UserPreference(db.Model):
             'name': self.name,
             'value': self.value
         }
+
+
+
+class ExchangeRateSnapshot(db.Model):
+    """
+    Exchange rates from the rates provider, relative to the "base" currency
+
+    Only the most recent snapshot of each day is kept.
+    """
+    id        = db.Column(db.Integer, primary_key=True)
+    day       = db.Column(db.Date, nullable=False, unique=True)
+    # Provider timestamp (seconds since epoch, UTC)
+    timestamp = db.Column(db.Integer, nullable=False)
+    base      = db.Column(db.String(5), nullable=False)
+    # JSON-encoded {<isocode>: <rate>} dictionary
+    rates     = db.Column(db.Text, nullable=False)
+
+    def __unicode__(self):
+        return u'Exchange rates of {0} (base "{1}", timestamp {2})'.format(
+                    self.day, self.base, self.timestamp
+                )
+
+    def as_dict(self):
+        return {
+            'day': self.day,
+            'timestamp': self.timestamp,
+            'base': self.base,
+            'rates': json.loads(self.rates)
+        }
@@ -22,6 +22,8 @@ from ospfm.objects import Object
 
 class Preference(Object):
 
+    cacheable = True
+
     def __own_preference(self, preferencename):
         return models.UserPreference.query.filter(
                     db.and_(
@@ -18,14 +18,15 @@
 import json
 import os
 
-from passlib.hash import sha512_crypt
-
 from flask import jsonify
 
-from ospfm import authentication, config, db
+from ospfm import authentication, config, db, helpers, passwords
 from ospfm.core import exchangerate, models
 from ospfm.objects import Object
 
+# Maximum number of users returned by a search
+SEARCH_LIMIT = 20
+
 class User(Object):
 
     def list(self):
@@ -77,34 +78,35 @@ class User(Object):
                     if len(self.args['password']) < 8:
                         self.badrequest(
                                'Password should be at least 8 characters long')
-                    user.passhash = sha512_crypt.encrypt(
-                                        self.args['password'],
-                                        rounds=config.PASSWORD_SALT_COMPLEXITY
+                    user.passhash = passwords.hash_password(
+                                        self.args['password']
                                     )
+                    # Devices logged in with the previous password must log
+                    # in again
+                    authentication.revoke_user_refresh_tokens(username)
                 else:
                     self.badrequest(
                                  "Please provide the correct current password")
             if 'preferred_currency' in self.args:
-                currency = models.Currency.query.filter(
-                  db.and_(
-                     models.Currency.isocode == self.args['preferred_currency'],
-                     models.Currency.owner_username == None,
-                  )
-                ).first()
+                currency = models.global_currency(
+                                self.args['preferred_currency']
+                           )
                 if currency:
                     # When preferred currency is changed, all owner's
                     # currencies rates must be changed
                     # XXX Debts amounts should also be changed... when debts will be implemented
-                    multiplier = user.preferred_currency
                     multiplier = exchangerate.getrate(
                         user.preferred_currency.isocode,
                         currency.isocode
                     )
+                    if multiplier is None:
+                        self.badrequest(
+                            "No exchange rate is known for this currency")
                     for c in models.Currency.query.filter(
                         models.Currency.owner_username == self.username
                     ):
                         c.rate = c.rate * multiplier
-                    user.preferred_currency = currency
+                    user.preferred_currency_id = currency.id
                     self.add_to_response('totalbalance')
             if 'emails' in self.args:
                 emails = json.loads(self.args['emails'])
@@ -168,6 +170,7 @@ class User(Object):
 
 
             db.session.commit()
+            helpers.forget_rates(self.username)
             return self.read(username)
         else:
             self.forbidden('The only user you can modify is yourself')
@@ -185,19 +188,11 @@ class User(Object):
             ).filter(
                 models.UserEmail.email_address == substring,
                 models.UserEmail.confirmation == 'OK'
-            )
+            ).limit(SEARCH_LIMIT)
         else:
-            substring=u'%{0}%'.format(substring)
-            corresponding_rows = models.User.query.filter(
-                db.and_(
-                    models.User.username != self.username,
-                    db.or_(
-                        models.User.username.like(substring),
-                        models.User.first_name.like(substring),
-                        models.User.last_name.like(substring),
-                    )
-                )
-            )
+            corresponding_rows = models.search_users(substring).filter(
+                models.User.username != self.username
+            ).limit(SEARCH_LIMIT)
 
         return [u.as_dict() for u in corresponding_rows.all()]
 
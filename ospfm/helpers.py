@@ -17,7 +17,7 @@
 
 import datetime
 
-from flask import request
+from flask import g, has_request_context
 
 from ospfm import config, db
 from ospfm.core import exchangerate
@@ -36,51 +36,133 @@ def date_from_string(string):
             pass
     return None
 
-def rate(username, fromisocode, toisocode):
-    if fromisocode == toisocode:
-        return 1
-    # Request the currencies
-    fromcurrency = core.Currency.query.filter(
-        db.and_(
-            core.Currency.isocode == fromisocode,
-            db.or_(
-                core.Currency.owner_username == username,
-                core.Currency.owner_username == None,
-            )
-        )
-    ).first()
-    tocurrency = core.Currency.query.filter(
-        db.and_(
-            core.Currency.isocode == toisocode,
-            db.or_(
-                core.Currency.owner_username == username,
-                core.Currency.owner_username == None,
-            )
-        )
-    ).first()
-    if not fromcurrency or not tocurrency:
-        return None
-    # Both currencies are globally defined
-    if (fromcurrency.rate is None) and (tocurrency.rate is None):
-        return exchangerate.getrate(fromcurrency.isocode, tocurrency.isocode)
-    # Both currencies are user-defined
-    elif (fromcurrency.rate is not None) and (tocurrency.rate is not None):
-        return tocurrency.rate / fromcurrency.rate
-    # Mixed user-defined / globally defined rates
-    else:
-        preferred_isocode = core.User.query.filter(
-                                core.User.username==username
-                           ).one().preferred_currency.isocode
-        # From a user-defined currency to a globally defined currency
-        if (fromcurrency.rate is not None) and (tocurrency.rate is None):
-            target_rate = exchangerate.getrate(preferred_isocode,
-                                               tocurrency.isocode)
-            if (fromcurrency.rate == 0):
-                return 0
-            return target_rate / fromcurrency.rate
-        if (fromcurrency.rate is None) and (tocurrency.rate is not None):
-            source_rate = exchangerate.getrate(preferred_isocode,
-                                               fromcurrency.isocode)
-            if (tocurrency.rate == 0):
-                return 0
-            return tocurrency.rate / source_rate
+class RateResolver(object):
+    """
+    Calculate exchange rates for a user
+
+    The user's currencies (and the globally defined ones) and his preferred
+    currency are loaded only once, and every calculated rate is remembered.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self.__currencies = None
+        self.__preferred_isocode = None
+        self.__rates = {}
+
+    def currencies(self):
+        """Return a {<isocode>: <user-defined rate or None>} dictionary"""
+        if self.__currencies is None:
+            self.__currencies = dict.fromkeys(core.load_global_currencies()[0])
+            for isocode, currency in \
+                            core.user_currencies(self.username)[0].items():
+                self.__currencies[isocode] = currency.rate
+        return self.__currencies
+
+    def preferred_isocode(self):
+        if self.__preferred_isocode is None:
+            self.__preferred_isocode = core.User.query.options(
+                                db.joinedload(core.User.preferred_currency)
+                            ).get(self.username).preferred_currency.isocode
+        return self.__preferred_isocode
+
+    def rate(self, fromisocode, toisocode, day=None):
+        """Return the rate at the given date, or the latest known rate"""
+        if fromisocode == toisocode:
+            return 1
+        key = (fromisocode, toisocode, day)
+        if key not in self.__rates:
+            rate = self.__rate(fromisocode, toisocode, day)
+            if rate is None:
+                # Unknown rate: not remembered
+                return None
+            self.__rates[key] = rate
+        return self.__rates[key]
+
+    def convert(self, entries, toisocode):
+        """
+        Convert many (<date>, <amount>, <currency isocode>) entries at once,
+        at the rates of their dates: return the list of converted amounts
+        (None when the rate is unknown)
+
+        Amounts between globally defined currencies are converted by the
+        rates history in one call, user-defined currencies have no history.
+        """
+        entries = list(entries)
+        currencies = self.currencies()
+        ratehistory = exchangerate.history()
+        historical = ratehistory.days and toisocode in currencies and \
+                     currencies[toisocode] is None
+        converted = [None] * len(entries)
+        globalentries = []
+        for index, (day, amount, fromisocode) in enumerate(entries):
+            if fromisocode == toisocode:
+                converted[index] = amount
+            elif historical and fromisocode in currencies and \
+                 currencies[fromisocode] is None:
+                globalentries.append(index)
+            else:
+                rate = self.rate(fromisocode, toisocode, day)
+                if rate is not None:
+                    converted[index] = amount * rate
+        if globalentries:
+            for index, amount in zip(globalentries, ratehistory.convert(
+                            [entries[index] for index in globalentries],
+                            toisocode)):
+                converted[index] = amount
+        return converted
+
+    def __rate(self, fromisocode, toisocode, day):
+        currencies = self.currencies()
+        if fromisocode not in currencies or toisocode not in currencies:
+            return None
+        fromrate = currencies[fromisocode]
+        torate = currencies[toisocode]
+        # Both currencies are globally defined
+        if (fromrate is None) and (torate is None):
+            return exchangerate.getrate(fromisocode, toisocode, day=day)
+        # Both currencies are user-defined
+        elif (fromrate is not None) and (torate is not None):
+            return torate / fromrate
+        # Mixed user-defined / globally defined rates
+        else:
+            preferred_isocode = self.preferred_isocode()
+            # From a user-defined currency to a globally defined currency
+            if (fromrate is not None) and (torate is None):
+                target_rate = exchangerate.getrate(preferred_isocode,
+                                                   toisocode, day=day)
+                if target_rate is None:
+                    return None
+                if (fromrate == 0):
+                    return 0
+                return target_rate / fromrate
+            if (fromrate is None) and (torate is not None):
+                source_rate = exchangerate.getrate(preferred_isocode,
+                                                   fromisocode, day=day)
+                if source_rate is None:
+                    return None
+                if (torate == 0):
+                    return 0
+                return torate / source_rate
+
+def resolver(username):
+    """Return the rate resolver of a user for the current request"""
+    if not has_request_context():
+        return RateResolver(username)
+    if not hasattr(g, 'rate_resolvers'):
+        g.rate_resolvers = {}
+    if username not in g.rate_resolvers:
+        g.rate_resolvers[username] = RateResolver(username)
+    return g.rate_resolvers[username]
+
+def forget_rates(username):
+    """
+    Forget rates calculated for a user and his cached currencies, after a
+    change of his currencies
+    """
+    core.forget_user_currencies(username)
+    if has_request_context() and hasattr(g, 'rate_resolvers'):
+        g.rate_resolvers.pop(username, None)
+
+def rate(username, fromisocode, toisocode, day=None):
+    return resolver(username).rate(fromisocode, toisocode, day)
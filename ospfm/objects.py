@@ -15,11 +15,14 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime, hashlib
+
 from flask import abort, jsonify, request
 from sqlalchemy.exc import StatementError
 
 import ospfm
 from ospfm import authentication, db
+from ospfm.core import exchangerate, models as coremodels
 
 class Object:
     """
@@ -34,12 +37,20 @@ class Object:
 
     ... self.args should be set to the args, especially for the "create" and
     "update" methods
+
+    ... changes should be committed with self.commit(), so multiple operations
+    may be executed in a single database transaction (see ospfm.batch)
+
+    ... "cacheable" should be set to True if GET responses only depend on the
+    user's data and on exchange rates, so they are sent with an ETag
     """
     emptyvalid = []
+    cacheable = False
 
     def __init__(self, **kwargs):
         self.args = kwargs
         self.add_data = []
+        self.batch = False
         # Empty values are forbidden if they are not in emptyvalid
         for item in self.args.items():
             if item[1] == '' and item[0] not in self.emptyvalid:
@@ -52,8 +63,9 @@ class Object:
                         )
 
     def add_to_response(self, *args):
-        """Adds an additional data to the response"""
-        self.add_data.append(args)
+        """Adds an additional data to the response (only once)"""
+        if args not in self.add_data:
+            self.add_data.append(args)
 
     def http_request(self, arg=None):
         """Deal with all HTTP requests"""
@@ -62,11 +74,25 @@ class Object:
         try:
             # Execute the request
             if request.method == 'GET':
+                if self.cacheable:
+                    etag = self.__etag()
+                    if request.if_none_match.contains(etag):
+                        # Nothing changed since the client's version
+                        notmodified = ospfm.app.response_class(status=304)
+                        notmodified.set_etag(etag)
+                        return notmodified
                 if arg:
                     response = self.read(arg)
                 else:
                     response = self.list()
-            elif request.method == 'POST':
+                if self.cacheable:
+                    jsonresponse = self.__response(response)
+                    jsonresponse.set_etag(etag)
+                    return jsonresponse
+            else:
+                # Any other request may modify the user's data
+                coremodels.bump_data_version(self.username)
+            if request.method == 'POST':
                 if '_method' in self.args and self.args['_method'] == 'delete':
                     self.delete(arg)
                     response = 'OK Deleted'
@@ -78,23 +104,59 @@ class Object:
             elif request.method == 'DELETE':
                 self.delete(arg)
                 response = 'OK Deleted'
-            # Create additional data
-            additional_data = []
-            for data in self.add_data:
-                additional_data.append([
-                    data[0],
-                    ospfm.additional_methods[data[0]](self.username, *data[1:])
-                ])
-            # JSON response
-            if additional_data:
-                return jsonify(status=200, response=response,
-                               additional=additional_data)
-            else:
-                return jsonify(status=200, response=response)
+            return self.__response(response)
         except StatementError:
             db.session.rollback()
             self.badrequest("Database error")
 
+    def __etag(self):
+        """
+        Return the ETag of the user's data : it changes with any modification
+        of the user's data, of exchange rates and every day (for balances)
+        """
+        return hashlib.sha1('{0}:{1}:{2}:{3}'.format(
+                    self.username.encode('utf8'),
+                    coremodels.data_version(self.username),
+                    exchangerate.version(),
+                    datetime.date.today().isoformat()
+               )).hexdigest()
+
+    def __response(self, response):
+        """Return the JSON response, with the additional data"""
+        # Create additional data : all requests of the same method are
+        # calculated together
+        methods = []
+        arguments = {}
+        for data in self.add_data:
+            if data[0] not in arguments:
+                methods.append(data[0])
+                arguments[data[0]] = []
+            arguments[data[0]].append(data[1:])
+        additional_data = []
+        context = {}
+        for method in methods:
+            for data in ospfm.additional_methods[method](
+                                self.username, arguments[method], context):
+                additional_data.append([method, data])
+        # JSON response
+        if additional_data:
+            return jsonify(status=200, response=response,
+                           additional=additional_data)
+        else:
+            return jsonify(status=200, response=response)
+
+    def commit(self):
+        """
+        Commit the changes or, in a batch, only send them to the database
+        (the batch is committed at the end)
+        """
+        if self.batch:
+            db.session.flush()
+            # Values updated by the database (balances...) must be read again
+            db.session.expire_all()
+        else:
+            db.session.commit()
+
     def list(self):
         """Override this method for objects listing"""
         raise NotImplementedError
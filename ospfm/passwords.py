@@ -0,0 +1,144 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import threading
+import time
+
+from passlib.hash import sha512_crypt
+
+from flask import abort
+
+from ospfm import config
+
+# Passwords are hashed and verified in a pool of processes, so a burst of
+# logins uses at most PASSWORD_WORKERS processors and does not hold the GIL of
+# the request workers: other requests are still served meanwhile.
+#
+# At most PASSWORD_QUEUE_LIMIT operations may be running or waiting at once,
+# further ones are refused with an HTTP error 503.
+
+WORKERS = getattr(config, 'PASSWORD_WORKERS', 2)
+QUEUE_LIMIT = getattr(config, 'PASSWORD_QUEUE_LIMIT', 20)
+# Maximum time to wait for a result, in seconds
+TIMEOUT = 30
+
+pool = None
+pool_lock = threading.Lock()
+slots = threading.BoundedSemaphore(QUEUE_LIMIT)
+
+stats_lock = threading.Lock()
+stats = {
+    'hash': {'count': 0, 'total': 0.0, 'max': 0.0},
+    'verify': {'count': 0, 'total': 0.0, 'max': 0.0},
+    'rejected': 0
+}
+
+
+########## Executed in the pool processes
+
+def run(function, args):
+    """
+    Call a function and return (True, <result>) or (False, <exception>), so
+    the pool always calls the callback of the operation
+    """
+    try:
+        return True, function(*args)
+    except Exception, e:
+        return False, e
+
+def encrypt(password, rounds):
+    return sha512_crypt.encrypt(password, rounds=rounds)
+
+def verify(password, passhash):
+    return sha512_crypt.verify(password, passhash)
+
+
+########## Executed in the request workers
+
+def get_pool():
+    """Return the pool of processes, created on first use in each process"""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = multiprocessing.Pool(WORKERS)
+        return pool
+
+def release_slot(result):
+    slots.release()
+
+def execute(operation, function, *args):
+    """
+    Execute a function in the pool and wait for its result, or abort with an
+    HTTP error 503 if too many operations are already waiting
+    """
+    if not slots.acquire(False):
+        with stats_lock:
+            stats['rejected'] += 1
+        abort(503, 'Too many login attempts, please retry later')
+    start = time.time()
+    # In the pool, the slot is released when the operation really ends, even
+    # if the request stopped waiting for it
+    released = False
+    try:
+        if WORKERS:
+            job = get_pool().apply_async(run, (function, args),
+                                         callback=release_slot)
+            released = True
+            success, result = job.get(TIMEOUT)
+            if not success:
+                raise result
+        else:
+            result = function(*args)
+    except multiprocessing.TimeoutError:
+        abort(503, 'Too many login attempts, please retry later')
+    finally:
+        if not released:
+            slots.release()
+    duration = time.time() - start
+    with stats_lock:
+        operationstats = stats[operation]
+        operationstats['count'] += 1
+        operationstats['total'] += duration
+        operationstats['max'] = max(operationstats['max'], duration)
+    return result
+
+def hash_password(password):
+    """Return the hash of a password"""
+    return execute('hash', encrypt, password, config.PASSWORD_SALT_COMPLEXITY)
+
+def check_password(password, passhash):
+    """Return True if the password corresponds to the hash"""
+    return execute('verify', verify, password, passhash)
+
+def get_stats():
+    """
+    Return the number of operations, their average and maximum durations (in
+    milliseconds) and the number of rejected operations
+    """
+    with stats_lock:
+        result = {'rejected': stats['rejected']}
+        for operation in ('hash', 'verify'):
+            operationstats = stats[operation]
+            count = operationstats['count']
+            result[operation] = {
+                'count': count,
+                'average': count and \
+                           int(operationstats['total'] * 1000 / count),
+                'max': int(operationstats['max'] * 1000)
+            }
+        return result
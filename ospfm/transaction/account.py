@@ -17,7 +17,7 @@
 
 from decimal import Decimal
 
-from ospfm import db, helpers
+from ospfm import db
 from ospfm.core import models as core
 from ospfm.core import currency as corecurrency
 from ospfm.transaction import models
@@ -26,6 +26,8 @@ from ospfm.objects import Object
 
 class Account(Object):
 
+    cacheable = True
+
     def __own_account(self, accountid):
         return models.Account.query.options(
                         db.joinedload(models.Account.currency)
@@ -37,26 +39,16 @@ class Account(Object):
                 ).first()
 
     def list(self):
-        accounts = models.Account.query.options(
-                        db.joinedload(models.Account.currency)
-        ).join(models.AccountOwner).filter(
-            models.AccountOwner.owner_username == self.username
-        ).all()
-        # Calculate the total balance, in the user's preferred currency
-        totalbalance = 0
-        totalcurrency = core.User.query.options(
-                            db.joinedload(core.User.preferred_currency)
-                        ).get(self.username).preferred_currency
-        for account in accounts:
-            totalbalance += account.balance(self.username)[0] * \
-            helpers.rate(self.username,
-                         account.currency.isocode,
-                         totalcurrency.isocode)
+        accounts = models.user_accounts(self.username)
+        balances = models.accounts_balances(self.username, accounts)
         return {
-            'accounts': [a.as_dict(self.username) for a in accounts],
+            'accounts': [
+                a.as_dict(self.username, balances=balances['accounts'][a.id])
+                for a in accounts
+            ],
             'total': {
-                'balance': totalbalance,
-                'currency': totalcurrency.isocode
+                'balance': balances['balance'],
+                'currency': balances['currency']
             }
         }
 
@@ -68,15 +60,7 @@ class Account(Object):
         ):
             self.badrequest(
                  "Please provide the account name, currency and start balance")
-        currency = core.Currency.query.filter(
-            db.and_(
-                core.Currency.isocode == self.args['currency'],
-                db.or_(
-                    core.Currency.owner_username == self.username,
-                    core.Currency.owner_username == None
-                )
-            )
-        ).first()
+        currency = core.find_currency(self.username, self.args['currency'])
         if not currency:
             self.badrequest("This currency does not exist")
 
@@ -85,12 +69,12 @@ class Account(Object):
 
         a = models.Account(
                 name=name,
-                currency=currency,
+                currency_id=currency.id,
                 start_balance=start_balance
         )
         ao = models.AccountOwner(account=a, owner_username=self.username)
         db.session.add_all((a, ao))
-        db.session.commit()
+        self.commit()
         self.add_to_response('totalbalance')
         return a.as_dict(self.username)
 
@@ -112,21 +96,14 @@ class Account(Object):
             if not models.TransactionAccount.query.filter(
                         models.TransactionAccount.account == account
                    ).count():
-                currency = core.Currency.query.filter(
-                    db.and_(
-                        core.Currency.isocode == self.args['currency'],
-                        db.or_(
-                            core.Currency.owner_username == self.username,
-                            core.Currency.owner_username == None
-                        )
-                    )
-                ).first()
+                currency = core.find_currency(self.username,
+                                              self.args['currency'])
                 if currency:
-                    account.currency = currency
+                    account.currency_id = currency.id
         if 'start_balance' in self.args:
             account.start_balance = Decimal(self.args['start_balance'])
             self.add_to_response('totalbalance')
-        db.session.commit()
+        self.commit()
         return account.as_dict(self.username)
 
     def delete(self, accountid):
@@ -135,5 +112,5 @@ class Account(Object):
             self.notfound(
                 'Nonexistent account cannot be deleted (or you do not own it)')
         db.session.delete(account)
-        db.session.commit()
+        self.commit()
         self.add_to_response('totalbalance')
@@ -15,57 +15,74 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-from ospfm import db, helpers
 from ospfm.transaction import models
-from ospfm.core import models as core
 
-def accountbalance(username, accountid):
-    account = models.Account.query.join(models.AccountOwner).filter(
-                    db.and_(
-                        models.AccountOwner.owner_username == username,
-                        models.Account.id == accountid
-                    )
-              ).first()
-    balances = account.balance(username)
-    return {
-        'id': accountid,
-        'balance': balances[0],
-        'balance_preferred': balances[1],
-        'transactions_count': account.transactions_count()
-    }
+# Additional methods receive the list of the arguments of all requests of the
+# same method in the response, and a dictionary shared by all methods of the
+# response. They return the list of additional data to send.
 
-def totalbalance(username):
-    accounts = models.Account.query.options(
-                    db.joinedload(models.Account.currency)
-    ).join(models.AccountOwner).filter(
-        models.AccountOwner.owner_username == username
-    ).all()
-    # Calculate the total balance, in the user's preferred currency
-    totalbalance = 0
-    totalcurrency = core.User.query.options(
-                        db.joinedload(core.User.preferred_currency)
-                    ).get(username).preferred_currency
-    for account in accounts:
-        totalbalance += account.balance(username)[0] * \
-        helpers.rate(username,
-                     account.currency.isocode,
-                     totalcurrency.isocode)
-    return {
-        'balance': totalbalance,
-        'currency': totalcurrency.isocode
-    }
+def __ids(arguments):
+    """Return the set of integer ids given as first arguments"""
+    ids = set()
+    for args in arguments:
+        try:
+            ids.add(int(args[0]))
+        except (IndexError, TypeError, ValueError):
+            pass
+    return ids
 
-def categoriesbalance(username, categoryid):
-    category = models.Category.query.filter(
-                    db.and_(
-                        models.Category.owner_username == username,
-                        models.Category.id == categoryid
-                    )
-              ).first()
-    balances = category.balance(username)
-    balances['id'] = categoryid
-    result = [ balances ]
-    # Also return parent category/ies balance(s)
-    if category.parent_id:
-        result.extend(categoriesbalance(username, category.parent_id))
-    return result
+def __accounts_balances(username, context):
+    """Return all accounts of the user and their balances, once"""
+    if 'accounts' not in context:
+        context['accounts'] = models.user_accounts(username)
+        context['balances'] = models.accounts_balances(username,
+                                                       context['accounts'])
+    return context['accounts'], context['balances']
+
+def accountbalance(username, arguments, context):
+    accountids = __ids(arguments)
+    accounts, balances = __accounts_balances(username, context)
+    return [
+        {
+            'id': account.id,
+            'balance': balances['accounts'][account.id][0],
+            'balance_preferred': balances['accounts'][account.id][1],
+            'transactions_count': account.transactions_count
+        } for account in accounts if account.id in accountids
+    ]
+
+def totalbalance(username, arguments, context):
+    if 'balances' in context:
+        balance = context['balances']['balance']
+        currency = context['balances']['currency']
+    else:
+        # Stored total, no need to get all accounts
+        balance, currency = models.total_balance(username)
+    return [{
+        'balance': balance,
+        'currency': currency
+    }]
+
+def categoriesbalance(username, arguments, context):
+    categoryids = __ids(arguments)
+    if not categoryids:
+        return []
+    # The categories and all their parents, each only once, from the closest
+    # to the requested categories
+    ancestorids = []
+    for link in models.CategoryClosure.query.filter(
+                    models.CategoryClosure.descendant_id.in_(categoryids)
+                ).order_by(models.CategoryClosure.depth):
+        if link.ancestor_id not in ancestorids:
+            ancestorids.append(link.ancestor_id)
+    # Balances of all categories of the user, at once
+    categories = dict([(c.id, c) for c in models.user_categories(username)])
+    allbalances = models.categories_balances(username, categories.values())
+    result = []
+    for categoryid in ancestorids:
+        if categoryid in categories:
+            balances = dict(categories[categoryid].balance(username,
+                                                           allbalances))
+            balances['id'] = categoryid
+            result.append(balances)
+    return [ result ]
@@ -24,6 +24,8 @@ from ospfm.objects import Object
 
 class Category(Object):
 
+    cacheable = True
+
     def __own_category(self, categoryid):
         return models.Category.query.options(
                         db.joinedload(models.Category.currency)
@@ -35,17 +37,11 @@ class Category(Object):
                ).first()
 
     def list(self):
-        categories = models.Category.query.order_by(
-                        models.Category.name
-                     ).options(
-                        db.joinedload(models.Category.currency)
-                     ).filter(
-                        db.and_(
-                            models.Category.owner_username == self.username,
-                            models.Category.parent_id == None
-                        )
-                     ).all()
-        return [c.as_dict(self.username) for c in categories]
+        categories = models.user_categories(self.username)
+        balances = models.categories_balances(self.username, categories)
+        return [c.as_dict(self.username, balances=balances)
+                for c in sorted(categories, key=lambda c: c.name)
+                if not c.parent_id]
 
     def create(self):
         if not ('currency' in self.args and 'name' in self.args):
@@ -56,25 +52,17 @@ class Category(Object):
                 self.badrequest("This parent category does not exist")
         else:
             parent = None
-        currency = core.Currency.query.filter(
-            db.and_(
-                core.Currency.isocode == self.args['currency'],
-                db.or_(
-                    core.Currency.owner_username == self.username,
-                    core.Currency.owner_username == None
-                )
-            )
-        ).first()
+        currency = core.find_currency(self.username, self.args['currency'])
         if not currency:
             self.badrequest("This currency does not exist")
         category = models.Category(
                         owner_username=self.username,
                         parent=parent,
-                        currency=currency,
+                        currency_id=currency.id,
                         name=self.args['name']
                    )
         db.session.add(category)
-        db.session.commit()
+        self.commit()
         return category.as_dict(self.username)
 
     def read(self, categoryid):
@@ -91,26 +79,29 @@ class Category(Object):
         if 'name' in self.args:
             category.name = self.args['name']
         if 'currency' in self.args:
-            currency = core.Currency.query.filter(
-                db.and_(
-                    core.Currency.isocode == self.args['currency'],
-                    db.or_(
-                        core.Currency.owner_username == self.username,
-                        core.Currency.owner_username == None
-                    )
-                )
-            ).first()
+            currency = core.find_currency(self.username, self.args['currency'])
             if currency:
                 rate = helpers.rate(
                             self.username,
                             category.currency.isocode,
                             currency.isocode
                        )
-                category.currency = currency
-                for tc in models.TransactionCategory.query.filter(
-                            models.TransactionCategory.category == category
-                          ).all():
-                    tc.category_amount = tc.category_amount * rate
+                if rate is None:
+                    self.badrequest(
+                        "No exchange rate is known for this currency")
+                category.currency_id = currency.id
+                # Rebase all amounts of the category (and its daily balances)
+                models.TransactionCategory.query.filter(
+                    models.TransactionCategory.category_id == category.id
+                ).update({
+                    'category_amount':
+                        models.TransactionCategory.category_amount * rate
+                }, synchronize_session=False)
+                models.CategoryDailyBalance.query.filter(
+                    models.CategoryDailyBalance.category_id == category.id
+                ).update({
+                    'amount': models.CategoryDailyBalance.amount * rate
+                }, synchronize_session=False)
         if 'parent' in self.args:
             if self.args['parent'] == 'NONE':
                 category.parent_id = None
@@ -130,7 +121,7 @@ class Category(Object):
                         if parentid:
                             self.add_to_response('categoriesbalance', parentid)
                     category.parent = parent
-        db.session.commit()
+        self.commit()
         return category.as_dict(self.username)
 
     def delete(self, categoryid):
@@ -139,4 +130,4 @@ class Category(Object):
             self.notfound(
                'Nonexistent category cannot be deleted (or you do not own it)')
         db.session.delete(category)
-        db.session.commit()
+        self.commit()
@@ -0,0 +1,167 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import cStringIO
+
+from flask import json
+
+from ospfm import db
+from ospfm.core import models as core
+from ospfm.transaction import models
+
+# Number of transactions read (and sent) at once
+BATCH_SIZE = 500
+
+
+########## Read
+#
+# Transactions are read by batches, from the smallest id, each batch starting
+# after the last id of the previous one: only flat columns are read (no ORM
+# object), and the memory used does not depend on the number of transactions
+
+def transaction_batches(username):
+    """
+    Yield lists of transactions dictionaries, in the following format:
+      {
+          'id': <id>,
+          'date': <date>,
+          'description': <description>,
+          'original_description': <original description>,
+          'amount': <amount>,
+          'currency': <isocode>,
+          'accounts': [{'id': <id>, 'amount': <amount>,
+                        'verified': <verified>}, [...]],
+          'categories': [{'id': <id>, 'transaction_amount': <amount>,
+                          'category_amount': <amount>}, [...]]
+      }
+    """
+    lastid = 0
+    while True:
+        rows = db.session.query(
+                    models.Transaction.id,
+                    models.Transaction.date,
+                    models.Transaction.description,
+                    models.Transaction.original_description,
+                    models.Transaction.amount,
+                    core.Currency.isocode
+               ).join(core.Currency).filter(
+                    db.and_(
+                        models.Transaction.owner_username == username,
+                        models.Transaction.id > lastid
+                    )
+               ).order_by(models.Transaction.id).limit(BATCH_SIZE).all()
+        if not rows:
+            return
+        batch = []
+        transactions = {}
+        for row in rows:
+            transaction = {
+                'id': row[0],
+                'date': row[1].strftime('%Y-%m-%d'),
+                'description': row[2],
+                'original_description': row[3],
+                'amount': row[4],
+                'currency': row[5],
+                'accounts': [],
+                'categories': []
+            }
+            batch.append(transaction)
+            transactions[row[0]] = transaction
+        ids = transactions.keys()
+        for transactionid, accountid, amount, verified in db.session.query(
+                    models.TransactionAccount.transaction_id,
+                    models.TransactionAccount.account_id,
+                    models.TransactionAccount.amount,
+                    models.TransactionAccount.verified
+                ).filter(models.TransactionAccount.transaction_id.in_(ids)):
+            transactions[transactionid]['accounts'].append({
+                'id': accountid,
+                'amount': amount,
+                'verified': verified
+            })
+        for transactionid, categoryid, transactionamount, categoryamount in \
+                db.session.query(
+                    models.TransactionCategory.transaction_id,
+                    models.TransactionCategory.category_id,
+                    models.TransactionCategory.transaction_amount,
+                    models.TransactionCategory.category_amount
+                ).filter(models.TransactionCategory.transaction_id.in_(ids)):
+            transactions[transactionid]['categories'].append({
+                'id': categoryid,
+                'transaction_amount': transactionamount,
+                'category_amount': categoryamount
+            })
+        yield batch
+        lastid = rows[-1][0]
+
+
+########## Formatters
+#
+# Formatters receive batches of transactions and yield strings: one string per
+# batch, so the response is written by chunks
+
+def format_ndjson(batches):
+    """One JSON object per line"""
+    for batch in batches:
+        yield ''.join([json.dumps(t) + '\n' for t in batch])
+
+CSV_COLUMNS = ('id', 'date', 'description', 'original_description', 'amount',
+               'currency', 'accounts', 'categories')
+
+def format_csv(batches):
+    """
+    CSV with a header line, accounts and categories links are in their own
+    column as "<id>:<amount>" separated with spaces (for categories, the
+    amount is in the transaction currency)
+    """
+    output = cStringIO.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CSV_COLUMNS)
+    yield output.getvalue()
+    output.seek(0)
+    output.truncate()
+    for batch in batches:
+        for transaction in batch:
+            writer.writerow([
+                transaction['id'],
+                transaction['date'],
+                transaction['description'].encode('utf8'),
+                transaction['original_description'].encode('utf8'),
+                transaction['amount'],
+                transaction['currency'],
+                ' '.join(['{0}:{1}'.format(a['id'], a['amount'])
+                          for a in transaction['accounts']]),
+                ' '.join(['{0}:{1}'.format(c['id'], c['transaction_amount'])
+                          for c in transaction['categories']])
+            ])
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+formatters = {
+    'ndjson': (format_ndjson, 'application/x-ndjson'),
+    'csv': (format_csv, 'text/csv')
+}
+
+
+########## Export
+
+def export_transactions(username, format):
+    """Return a generator of the chunks of the export of all transactions"""
+    formatter = formatters[format][0]
+    return formatter(transaction_batches(username))
@@ -0,0 +1,293 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import datetime
+import re
+from decimal import Decimal, InvalidOperation
+
+from ospfm import db, helpers
+from ospfm.transaction import models
+
+# Number of transactions inserted at once
+BATCH_SIZE = 500
+
+
+class ImportFormatError(ValueError):
+    """A line of an imported file cannot be understood"""
+
+    def __init__(self, line):
+        ValueError.__init__(self, 'Line {0} cannot be understood'.format(line))
+        self.line = line
+
+
+########## Parsers
+#
+# Parsers read a file line by line and yield one dictionary per transaction:
+#   {
+#       'line': <line number of the end of the transaction>,
+#       'date': <date>,
+#       'amount': <Decimal amount>,
+#       'description': <description>,
+#       'original_description': <original description>,
+#       'category': <category id, optional>
+#   }
+
+AMOUNT = re.compile(r'^[-+]?\d*([.,]\d+)*$')
+
+def parse_amount(value, line):
+    """
+    Parse an amount, with "." or "," as decimal separator and optionally the
+    other one (or spaces) as thousands separator: "1,234.5" or "1.234,5"
+
+    A single separator followed by 3 digits ("1,234" or "1.234") may either be
+    a thousands separator or a decimal separator: such amounts are rejected.
+    """
+    amount = value.strip().replace(' ', '')
+    if not AMOUNT.match(amount) or not amount.strip('-+'):
+        raise ImportFormatError(line)
+    sign = amount[0] in '-+' and amount[0] or ''
+    parts = re.split('([.,])', amount.lstrip('-+'))
+    groups, separators = parts[0::2], parts[1::2]
+    if len(separators) == 1 and len(groups[1]) == 3:
+        raise ImportFormatError(line)
+    decimals = None
+    if len(separators) == 1 or len(set(separators)) == 2:
+        # The last separator is the decimal separator
+        separator = separators.pop()
+        decimals = groups.pop()
+        if separator in separators:
+            raise ImportFormatError(line)
+    # Other separators are thousands separators, between groups of 3 digits
+    if separators and (not groups[0] or
+                       [g for g in groups[1:] if len(g) != 3]):
+        raise ImportFormatError(line)
+    number = sign + (''.join(groups) or '0')
+    if decimals is not None:
+        number += '.' + decimals
+    try:
+        return Decimal(number)
+    except InvalidOperation:
+        raise ImportFormatError(line)
+
+def parse_csv(stream):
+    """
+    CSV files with a header line, containing at least the "date" (YYYY-MM-DD),
+    "description" and "amount" columns, and optionally the
+    "original_description" and "category" (id) columns
+    """
+    reader = csv.DictReader(stream)
+    for row in reader:
+        date = helpers.date_from_string(row.get('date') or '')
+        if not date or not row.get('description') or not row.get('amount'):
+            raise ImportFormatError(reader.line_num)
+        description = row['description'].decode('utf8', 'replace')
+        transaction = {
+            'line': reader.line_num,
+            'date': date,
+            'amount': parse_amount(row['amount'], reader.line_num),
+            'description': description,
+            'original_description': (row.get('original_description') or
+                                     row['description']).decode('utf8',
+                                                                'replace')
+        }
+        if row.get('category'):
+            try:
+                transaction['category'] = int(row['category'])
+            except ValueError:
+                raise ImportFormatError(reader.line_num)
+        yield transaction
+
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+def parse_ofx(stream):
+    """OFX files (either SGML or XML), only STMTTRN elements are read"""
+    transaction = None
+    for linenumber, line in enumerate(stream, 1):
+        for closing, tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            value = value.strip().decode('utf8', 'replace')
+            if tag == 'STMTTRN':
+                if not closing:
+                    transaction = {}
+                    continue
+                if not ('DTPOSTED' in transaction and
+                        'TRNAMT' in transaction):
+                    raise ImportFormatError(linenumber)
+                dtposted = transaction['DTPOSTED']
+                try:
+                    date = datetime.date(int(dtposted[:4]),
+                                         int(dtposted[4:6]),
+                                         int(dtposted[6:8]))
+                except ValueError:
+                    raise ImportFormatError(linenumber)
+                description = transaction.get('NAME') or \
+                              transaction.get('MEMO') or ''
+                yield {
+                    'line': linenumber,
+                    'date': date,
+                    'amount': parse_amount(transaction['TRNAMT'], linenumber),
+                    'description': description,
+                    'original_description': transaction.get('MEMO') or \
+                                            description
+                }
+                transaction = None
+            elif transaction is not None and not closing and value:
+                transaction[tag] = value
+
+def parse_qif_date(value):
+    """QIF dates : MM/DD/YYYY, MM/DD'YY or YYYY-MM-DD"""
+    date = helpers.date_from_string(value)
+    if date:
+        return date
+    try:
+        month, day, year = re.split(r"[/']", value.replace(' ', ''))
+        year = int(year)
+        if year < 100:
+            year = year + 2000
+        return datetime.date(year, int(month), int(day))
+    except ValueError:
+        return None
+
+def parse_qif(stream):
+    """QIF files, only the D(ate), T(amount), P(ayee) and M(emo) fields"""
+    transaction = {}
+    for linenumber, line in enumerate(stream, 1):
+        line = line.rstrip('\r\n').decode('utf8', 'replace')
+        if not line or line.startswith('!'):
+            continue
+        if line[0] == '^':
+            if transaction:
+                date = parse_qif_date(transaction.get('D', ''))
+                if not date or 'T' not in transaction:
+                    raise ImportFormatError(linenumber)
+                description = transaction.get('P') or \
+                              transaction.get('M') or ''
+                yield {
+                    'line': linenumber,
+                    'date': date,
+                    'amount': parse_amount(transaction['T'], linenumber),
+                    'description': description,
+                    'original_description': transaction.get('M') or \
+                                            description
+                }
+            transaction = {}
+        else:
+            transaction[line[0]] = line[1:].strip()
+
+parsers = {
+    'csv': parse_csv,
+    'ofx': parse_ofx,
+    'qif': parse_qif
+}
+
+
+########## Import
+
+def import_transactions(username, transactions, account, category=None):
+    """
+    Import transactions (from a parser) into an account, and in the given
+    category if no category is specified in the file
+
+    Transactions are inserted by batches, their links to accounts and
+    categories with multi-rows inserts. Account balance and categories daily
+    balances are updated once at the end.
+
+    Nothing is committed: the caller is responsible for it.
+    Return the number of imported transactions.
+    """
+    resolver = helpers.resolver(username)
+    categories = dict([(c.id, c) for c in models.Category.query.options(
+                        db.joinedload(models.Category.currency)
+                    ).filter(
+                        models.Category.owner_username == username
+                    )])
+    state = {
+        'count': 0,
+        'sum': 0,
+        'days': set()
+    }
+
+    def insert(batch):
+        transactionobjects = []
+        for data in batch:
+            description = data['description'][:200] or u'-'
+            transactionobjects.append(models.Transaction(
+                owner_username = username,
+                description = description,
+                original_description = \
+                            data['original_description'][:200] or description,
+                amount = data['amount'],
+                currency_id = account.currency_id,
+                date = data['date']
+            ))
+        db.session.add_all(transactionobjects)
+        # Get the transactions ids
+        db.session.flush()
+        transactionaccounts = []
+        transactioncategories = []
+        for data, transaction in zip(batch, transactionobjects):
+            transactionaccounts.append({
+                'transaction_id': transaction.id,
+                'account_id': account.id,
+                'amount': data['amount'],
+                'verified': False
+            })
+            state['count'] += 1
+            state['sum'] += data['amount']
+            transactioncategory = categories.get(data.get('category'),
+                                                 category)
+            if transactioncategory:
+                rate = resolver.rate(account.currency.isocode,
+                                     transactioncategory.currency.isocode,
+                                     data['date'])
+                if rate is None:
+                    raise ImportFormatError(data['line'])
+                transactioncategories.append({
+                    'transaction_id': transaction.id,
+                    'category_id': transactioncategory.id,
+                    'transaction_amount': data['amount'],
+                    'category_amount': data['amount'] * rate
+                })
+                state['days'].add((transactioncategory.id, data['date']))
+        db.session.execute(models.TransactionAccount.__table__.insert(),
+                           transactionaccounts)
+        if transactioncategories:
+            db.session.execute(models.TransactionCategory.__table__.insert(),
+                               transactioncategories)
+
+    batch = []
+    for data in transactions:
+        if data.get('category') and data['category'] not in categories:
+            raise ImportFormatError(data['line'])
+        batch.append(data)
+        if len(batch) == BATCH_SIZE:
+            insert(batch)
+            batch = []
+    if batch:
+        insert(batch)
+
+    # Inserts above do not go through the mapper events, update balances once
+    connection = db.session.connection()
+    if state['count']:
+        models.update_account_balance(connection, account.id,
+                                      state['sum'], state['count'])
+        models.add_to_total_balances(db.session, {account.id: state['sum']})
+    models.update_category_daily_balances(connection, state['days'])
+    models.invalidate_balances(db.session,
+                               set([c for c, day in state['days']]))
+    return state['count']
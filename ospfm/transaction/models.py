@@ -17,8 +17,17 @@
 
 
 import datetime
+import re
+import time
+import weakref
+from decimal import Decimal
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 
 from ospfm import config, db, helpers
+from ospfm.cache import is_shared
 from ospfm.core import exchangerate, models as coremodels
 
 cache = config.CACHE
@@ -30,6 +39,11 @@ class Account(db.Model):
     name          = db.Column(db.String(50), nullable=False)
     currency_id   = db.Column(db.ForeignKey('currency.id', ondelete='CASCADE'))
     start_balance = db.Column(db.Numeric(15, 3), nullable=False)
+    # Sum and number of the account's TransactionAccount amounts, maintained
+    # by the TransactionAccount mapper events below
+    transactions_sum   = db.Column(db.Numeric(15, 3), nullable=False,
+                                   default=0)
+    transactions_count = db.Column(db.Integer, nullable=False, default=0)
 
     currency = db.relationship('Currency')
 
@@ -44,36 +58,9 @@ class Account(db.Model):
         Return a list :
             [ <balance in account currency>, <balance in preferred currency> ]
         """
-        balance = db.session.query(
-            db.func.sum(TransactionAccount.amount)
-        ).filter(
-            TransactionAccount.account_id == self.id
-        ).one()[0]
-        if balance:
-            balances = [ self.start_balance + balance ]
-        else:
-            balances = [ self.start_balance ]
-        balances.append(
-            helpers.rate(
-                username,
-                self.currency.isocode,
-                coremodels.User.query.options(
-                    db.joinedload(coremodels.User.preferred_currency)
-                ).get(
-                    username
-                ).preferred_currency.isocode
-            ) * balances[0]
-        )
-        return balances
+        return accounts_balances(username, [self])['accounts'][self.id]
 
-    def transactions_count(self):
-        return db.session.query(
-            db.func.count(TransactionAccount.transaction_id)
-        ).filter(
-            TransactionAccount.account_id == self.id
-        ).one()[0] or 0
-
-    def as_dict(self, username, short=False):
+    def as_dict(self, username, short=False, balances=None):
         if short:
             return {
                 'id': self.id,
@@ -81,7 +68,8 @@ class Account(db.Model):
                 'currency': self.currency.isocode
             }
         else:
-            balances = self.balance(username)
+            if balances is None:
+                balances = self.balance(username)
             return {
                 'id': self.id,
                 'name': self.name,
@@ -89,10 +77,204 @@ class Account(db.Model):
                 'start_balance': self.start_balance,
                 'balance': balances[0],
                 'balance_preferred': balances[1],
-                'transactions_count': self.transactions_count()
+                'transactions_count': self.transactions_count or 0
             }
 
 
+def user_accounts(username):
+    """Return all accounts owned by a user, with their currencies"""
+    return Account.query.options(
+                    db.joinedload(Account.currency)
+    ).join(AccountOwner).filter(
+        AccountOwner.owner_username == username
+    ).all()
+
+def accounts_balances(username, accounts):
+    """
+    Return the balances of multiple accounts at once, and their total :
+        {
+            'accounts': {
+                <account id>: [ <balance in account currency>,
+                                <balance in preferred currency, or None
+                                 if no exchange rate is known> ],
+                [...]
+            },
+            'balance': <total balance in preferred currency>,
+            'currency': <preferred currency isocode>
+        }
+
+    The preferred currency and the rates come from the request's rate
+    resolver, so they are only requested once.
+    """
+    resolver = helpers.resolver(username)
+    preferred_isocode = resolver.preferred_isocode()
+    balances = {}
+    total = 0
+    for account in accounts:
+        balance = account.start_balance + (account.transactions_sum or 0)
+        rate = resolver.rate(account.currency.isocode, preferred_isocode)
+        if rate is None:
+            # No exchange rate for the account currency: not in the total
+            balances[account.id] = [balance, None]
+            continue
+        balances[account.id] = [balance, balance * rate]
+        total += balances[account.id][1]
+    return {
+        'accounts': balances,
+        'balance': total,
+        'currency': preferred_isocode
+    }
+
+
+# Total balances
+#
+# The total balance of each user is stored in the user table. Writes on
+# accounts add the converted difference to the total of all owners in the same
+# database transaction. The total is set to NULL when exchange rates, the
+# user's currencies or accounts owners change: it is then computed again by the
+# next write on the user's accounts (or by the "rebuild-balances" maintenance
+# command), reads only compute it without storing it.
+
+def total_balance(username):
+    """Return the total balance of a user and the preferred currency isocode"""
+    user = coremodels.User.__table__
+    balance, balancerates = db.session.execute(
+        db.select([
+            user.c.total_balance,
+            user.c.total_balance_rates
+        ]).where(user.c.username == username)
+    ).first()
+    if balance is not None and balancerates == exchangerate.version():
+        return balance, helpers.resolver(username).preferred_isocode()
+    balances = accounts_balances(username, user_accounts(username))
+    return balances['balance'], balances['currency']
+
+def compute_total_balance(connection, username):
+    """
+    Compute the total balance of a user from his accounts balances, or return
+    None if a rate is unknown
+    """
+    owner = AccountOwner.__table__
+    account = Account.__table__
+    currency = coremodels.Currency.__table__
+    resolver = helpers.resolver(username)
+    preferred_isocode = resolver.preferred_isocode()
+    total = 0
+    for isocode, balance in connection.execute(
+        db.select([
+            currency.c.isocode,
+            db.func.sum(account.c.start_balance + account.c.transactions_sum)
+        ]).where(
+            db.and_(
+                owner.c.owner_username == username,
+                account.c.id == owner.c.account_id,
+                currency.c.id == account.c.currency_id
+            )
+        ).group_by(currency.c.isocode)
+    ):
+        rate = resolver.rate(isocode, preferred_isocode)
+        if rate is None:
+            return None
+        total += Decimal(str(balance)) * rate
+    return total
+
+def fill_total_balances(session, usernames):
+    """Compute again the total balances of these users, if not stored"""
+    if not usernames:
+        return
+    user = coremodels.User.__table__
+    connection = session.connection()
+    ratesversion = exchangerate.version()
+    for (username,) in connection.execute(
+        db.select([user.c.username]).where(
+            db.and_(
+                user.c.username.in_(usernames),
+                db.or_(
+                    user.c.total_balance == None,
+                    user.c.total_balance_rates != ratesversion
+                )
+            )
+        )
+    ).fetchall():
+        balance = compute_total_balance(connection, username)
+        if balance is not None:
+            connection.execute(
+                user.update().where(
+                    user.c.username == username
+                ).values(
+                    total_balance = balance,
+                    total_balance_rates = ratesversion
+                )
+            )
+
+def add_to_total_balances(session, differences):
+    """
+    Add differences of accounts balances ({<account id>: <difference in the
+    account currency>}) to the total balances of their owners
+    """
+    if not differences:
+        return
+    owner = AccountOwner.__table__
+    account = Account.__table__
+    currency = coremodels.Currency.__table__
+    connection = session.connection()
+    totals = {}
+    invalid = set()
+    for accountid, username, isocode in connection.execute(
+        db.select([
+            owner.c.account_id,
+            owner.c.owner_username,
+            currency.c.isocode
+        ]).where(
+            db.and_(
+                owner.c.account_id.in_(differences.keys()),
+                account.c.id == owner.c.account_id,
+                currency.c.id == account.c.currency_id
+            )
+        )
+    ):
+        resolver = helpers.resolver(username)
+        rate = resolver.rate(isocode, resolver.preferred_isocode())
+        if rate is None:
+            invalid.add(username)
+        else:
+            totals[username] = totals.get(username, 0) + \
+                               differences[accountid] * rate
+    ratesversion = exchangerate.version()
+    user = coremodels.User.__table__
+    for username, difference in totals.items():
+        connection.execute(
+            user.update().where(
+                user.c.username == username
+            ).values(
+                # Computed with other rates : it will be computed again
+                total_balance = db.case([
+                    (user.c.total_balance_rates == ratesversion,
+                     user.c.total_balance + difference)
+                ]),
+                # Other owners of shared accounts get new ETags too
+                data_version = user.c.data_version + 1
+            )
+        )
+    invalidate_total_balances(session, invalid)
+    # Totals which were not stored (or computed with other rates)
+    fill_total_balances(session, set(totals) - invalid)
+
+def invalidate_total_balances(session, usernames):
+    """The total balances of these users will be computed again"""
+    if not usernames:
+        return
+    user = coremodels.User.__table__
+    session.connection().execute(
+        user.update().where(
+            user.c.username.in_(usernames)
+        ).values(
+            total_balance = None,
+            data_version = user.c.data_version + 1
+        )
+    )
+
+
 
 class AccountOwner(db.Model):
     account_id     = db.Column(db.ForeignKey('account.id', ondelete='CASCADE'),
@@ -135,133 +317,355 @@ class Category(db.Model):
         else:
             return u'Category id {0}, name "{1}"'.format(self.id, self.name)
 
-    def balance(self, username):
-        today = datetime.date.today()
+    def balance(self, username, balances=None):
+        """
+        Return the balance of the category, including its children. Balances
+        may have been calculated before with "categories_balances".
+        """
+        if balances is None:
+            balances = categories_balances(username, self.subtree())
+        return balances[self.id]
 
-        balance = cache.get('categorybalance-{0}'.format(self.id))
+    def subtree(self):
+        """Return this category and all its children, with their currencies"""
+        categories = Category.query.options(
+                        db.joinedload(Category.currency)
+                     ).join(
+                        CategoryClosure,
+                        CategoryClosure.descendant_id == Category.id
+                     ).filter(
+                        CategoryClosure.ancestor_id == self.id
+                     ).all()
+        load_children(categories)
+        return categories
 
-        if not balance:
-            balance = {'currency': self.currency.isocode}
-            balance['year'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        datetime.date(today.year, 1, 1),
-                        datetime.date(today.year, 12, 31)
-                    )
-                )
-            ).one()[0] or 0
-
-            if today.month == 12:
-                lastdayofmonth = datetime.date(today.year, 12, 31)
-            else:
-                lastdayofmonth = datetime.date(today.year, today.month+1, 1) -\
-                                                          datetime.timedelta(1)
-            balance['month'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        datetime.date(today.year, today.month, 1),
-                        lastdayofmonth
+    def all_parents_ids(self):
+        """Return the ids of all parents, from the closest one"""
+        return [c.ancestor_id for c in CategoryClosure.query.filter(
+                    db.and_(
+                        CategoryClosure.descendant_id == self.id,
+                        CategoryClosure.depth > 0
                     )
-                )
-            ).one()[0] or 0
+                ).order_by(CategoryClosure.depth)]
 
-            firstdayofweek = today - datetime.timedelta(today.weekday())
-            lastdayofweek = today + datetime.timedelta(6-today.weekday())
-            balance['week'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        firstdayofweek,
-                        lastdayofweek
+    def all_children_ids(self):
+        """Return the ids of all children, at any depth"""
+        return [c.descendant_id for c in CategoryClosure.query.filter(
+                    db.and_(
+                        CategoryClosure.ancestor_id == self.id,
+                        CategoryClosure.depth > 0
                     )
-                )
-            ).one()[0] or 0
+                )]
 
-            balance['7days'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        today - datetime.timedelta(6),
-                        today
-                    )
-                )
-            ).one()[0] or 0
-
-            balance['30days'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        today - datetime.timedelta(29),
-                        today
+    def contains_category(self, categoryid):
+        return CategoryClosure.query.filter(
+                    db.and_(
+                        CategoryClosure.ancestor_id == self.id,
+                        CategoryClosure.descendant_id == categoryid
                     )
-                )
-            ).one()[0] or 0
-
-            # Cache the balance only for 5 seconds : it helps when listing
-            # multiple categories by reducing sql requests
-            cache.set('categorybalance-{0}'.format(self.id), balance, 5)
-
-        for child in self.children:
-            child_balance = child.balance(username)
-            rate = helpers.rate(username,
-                              child_balance['currency'], self.currency.isocode)
-            balance['year'] = balance['year'] + child_balance['year'] * rate
-            balance['month'] = balance['month'] + child_balance['month'] * rate
-            balance['week'] = balance['week'] + child_balance['week'] * rate
-            balance['7days'] = balance['7days'] + child_balance['7days'] * rate
-            balance['30days'] = balance['30days'] +child_balance['30days']*rate
-
-        return balance
-
-    def all_parents_ids(self):
-        parents = []
-        if self.parent_id:
-            parents.append(self.parent_id)
-            parents = parents + self.parent.all_parents_ids()
-        return parents
+               ).count() > 0
 
-    def contains_category(self, categoryid):
-        if self.id == categoryid:
-            return True
-        if self.children:
-            for c in self.children:
-                if c.contains_category(categoryid):
-                    return True
-        return False
-
-    def as_dict(self, username, parent=True, children=True, balance=True):
+    def as_dict(self, username, parent=True, children=True, balance=True,
+                balances=None):
         desc = {
             'id': self.id,
             'name': self.name,
             'currency': self.currency.isocode,
         }
         if balance:
-            desc.update(self.balance(username))
+            if balances is None:
+                balances = categories_balances(username, self.subtree())
+            desc.update(self.balance(username, balances))
         if parent and self.parent_id:
             desc['parent'] = self.parent_id
         if children and self.children:
-            desc['children'] = [c.as_dict(username, False) \
+            desc['children'] = [c.as_dict(username, False, balances=balances) \
                                                         for c in self.children]
         return desc
 
 
+def user_categories(username):
+    """Return all categories of a user, with their currencies and children"""
+    categories = Category.query.options(
+                    db.joinedload(Category.currency)
+                 ).filter(
+                    Category.owner_username == username
+                 ).all()
+    load_children(categories)
+    return categories
+
+def load_children(categories):
+    """
+    Fill the "children" of categories from the given list (which must contain
+    whole subtrees), instead of requesting them for each category
+    """
+    children = dict([(c.id, []) for c in categories])
+    for category in categories:
+        if category.parent_id in children:
+            children[category.parent_id].append(category)
+    for category in categories:
+        set_committed_value(category, 'children',
+                            sorted(children[category.id], key=lambda c: c.name))
+
+def balance_periods(today):
+    """Return the (<name>, <first day>, <last day>) of balance periods"""
+    if today.month == 12:
+        lastdayofmonth = datetime.date(today.year, 12, 31)
+    else:
+        lastdayofmonth = datetime.date(today.year, today.month+1, 1) - \
+                                                          datetime.timedelta(1)
+    return (
+        ('year', datetime.date(today.year, 1, 1),
+                 datetime.date(today.year, 12, 31)),
+        ('month', datetime.date(today.year, today.month, 1), lastdayofmonth),
+        ('week', today - datetime.timedelta(today.weekday()),
+                 today + datetime.timedelta(6-today.weekday())),
+        ('7days', today - datetime.timedelta(6), today),
+        ('30days', today - datetime.timedelta(29), today),
+    )
+
+def categories_balances(username, categories):
+    """
+    Return the balances of categories (which must be whole subtrees) :
+        {
+            <category id>: {
+                'currency': <category currency isocode>,
+                'year': <balance>,
+                'month': <balance>,
+                'week': <balance>,
+                '7days': <balance>,
+                '30days': <balance>
+            },
+            [...]
+        }
+
+    All periods of all categories are summed by one query on the daily
+    balances, then children balances are added to their parents' ones. Children
+    in another currency than their parent are converted at the rates of each
+    day: when currencies differ, the daily balances themselves are read and
+    converted in bulk by the rate resolver. Balances are cached until a change
+    of the categories, their currencies or exchange rates (see below).
+    """
+    keys = balance_keys(username, categories)
+    cached = dict(zip(keys.keys(), cache.get_many(*keys.values())))
+    if None not in cached.values():
+        return cached
+
+    periods = balance_periods(datetime.date.today())
+    firstday = min([first for name, first, last in periods])
+    lastday = max([last for name, first, last in periods])
+    categoryids = [c.id for c in categories]
+    mixed = len(set([c.currency_id for c in categories])) > 1
+    sums = {}
+    daily = {}
+    if categories and mixed:
+        for categoryid, day, amount in db.session.query(
+            CategoryDailyBalance.category_id,
+            CategoryDailyBalance.day,
+            CategoryDailyBalance.amount
+        ).filter(
+            db.and_(
+                CategoryDailyBalance.category_id.in_(categoryids),
+                CategoryDailyBalance.day.between(firstday, lastday)
+            )
+        ):
+            daily.setdefault(categoryid, {})[day] = amount
+    elif categories:
+        for row in db.session.query(
+            CategoryDailyBalance.category_id,
+            *[
+                db.func.sum(db.case(
+                    [(CategoryDailyBalance.day.between(first, last),
+                      CategoryDailyBalance.amount)],
+                    else_=0
+                )) for name, first, last in periods
+            ]
+        ).filter(
+            db.and_(
+                CategoryDailyBalance.category_id.in_(categoryids),
+                CategoryDailyBalance.day.between(firstday, lastday)
+            )
+        ).group_by(CategoryDailyBalance.category_id):
+            sums[row[0]] = row[1:]
+
+    children = dict([(c.id, []) for c in categories])
+    for category in categories:
+        if category.parent_id in children:
+            children[category.parent_id].append(category)
+    resolver = helpers.resolver(username)
+    balances = {}
+
+    def rollup(category):
+        """Sum the periods of a category, all in the same currency"""
+        balance = {'currency': category.currency.isocode}
+        own = sums.get(category.id)
+        for index, (name, first, last) in enumerate(periods):
+            balance[name] = own and own[index] or 0
+        for child in children[category.id]:
+            child_balance = rollup(child)
+            for name, first, last in periods:
+                balance[name] = balance[name] + child_balance[name]
+        balances[category.id] = balance
+        return balance
+
+    def rollup_days(category):
+        """Sum the days of a category and return them"""
+        isocode = category.currency.isocode
+        days = dict(daily.get(category.id, {}))
+        for child in children[category.id]:
+            child_days = rollup_days(child).items()
+            converted = resolver.convert(
+                [(day, amount, child.currency.isocode)
+                 for day, amount in child_days],
+                isocode
+            )
+            for (day, amount), value in zip(child_days, converted):
+                # Days without exchange rate cannot be added (the child's
+                # own balance is still given)
+                if value is not None:
+                    days[day] = days.get(day, 0) + value
+        balance = {'currency': isocode}
+        for name, first, last in periods:
+            balance[name] = sum([amount for day, amount in days.items()
+                                 if first <= day <= last])
+        balances[category.id] = balance
+        return days
+
+    for category in categories:
+        if category.parent_id not in children:
+            if mixed:
+                rollup_days(category)
+            else:
+                rollup(category)
+    for categoryid, balance in balances.items():
+        cache.set(keys[categoryid], balance, BALANCE_CACHE_DURATION)
+    return balances
+
+
+
+class CategoryClosure(db.Model):
+    """
+    Link from each category to itself and to all its children at any depth
+    (depth 0 is the category itself, depth 1 its direct children, etc)
+
+    Maintained by the Category mapper events below.
+    """
+    ancestor_id   = db.Column(db.ForeignKey('category.id', ondelete='CASCADE'),
+                              primary_key=True)
+    descendant_id = db.Column(db.ForeignKey('category.id', ondelete='CASCADE'),
+                              primary_key=True, index=True)
+    depth         = db.Column(db.Integer, nullable=False)
+
+
+# Categories closure maintenance
+
+def closure_attach(connection, categoryid, parentid):
+    """Link a category and all its children to a parent and its ancestors"""
+    closure = CategoryClosure.__table__
+    ancestors = connection.execute(
+        db.select([closure.c.ancestor_id, closure.c.depth]).where(
+            closure.c.descendant_id == parentid
+        )
+    ).fetchall()
+    descendants = connection.execute(
+        db.select([closure.c.descendant_id, closure.c.depth]).where(
+            closure.c.ancestor_id == categoryid
+        )
+    ).fetchall()
+    links = [
+        {
+            'ancestor_id': ancestor.ancestor_id,
+            'descendant_id': descendant.descendant_id,
+            'depth': ancestor.depth + descendant.depth + 1
+        } for ancestor in ancestors for descendant in descendants
+    ]
+    if links:
+        connection.execute(closure.insert(), links)
+
+def closure_detach(connection, categoryid):
+    """Unlink a category and all its children from all its ancestors"""
+    closure = CategoryClosure.__table__
+    ancestors = [a.ancestor_id for a in connection.execute(
+        db.select([closure.c.ancestor_id]).where(
+            db.and_(
+                closure.c.descendant_id == categoryid,
+                closure.c.depth > 0
+            )
+        )
+    )]
+    if ancestors:
+        descendants = [d.descendant_id for d in connection.execute(
+            db.select([closure.c.descendant_id]).where(
+                closure.c.ancestor_id == categoryid
+            )
+        )]
+        connection.execute(
+            closure.delete().where(
+                db.and_(
+                    closure.c.ancestor_id.in_(ancestors),
+                    closure.c.descendant_id.in_(descendants)
+                )
+            )
+        )
+
+@event.listens_for(Category, 'after_insert')
+def category_inserted(mapper, connection, target):
+    connection.execute(CategoryClosure.__table__.insert(), {
+        'ancestor_id': target.id,
+        'descendant_id': target.id,
+        'depth': 0
+    })
+    if target.parent_id:
+        closure_attach(connection, target.id, target.parent_id)
+
+@event.listens_for(Category, 'after_update')
+def category_updated(mapper, connection, target):
+    history = get_history(target, 'parent_id')
+    if history.added or history.deleted:
+        closure_detach(connection, target.id)
+        if target.parent_id:
+            closure_attach(connection, target.id, target.parent_id)
+
+@event.listens_for(Category, 'after_delete')
+def category_deleted(mapper, connection, target):
+    # Children have been moved to the root before (their parent_id is
+    # set to NULL), only links to this category remain
+    closure = CategoryClosure.__table__
+    connection.execute(
+        closure.delete().where(
+            db.or_(
+                closure.c.ancestor_id == target.id,
+                closure.c.descendant_id == target.id
+            )
+        )
+    )
+    daily = CategoryDailyBalance.__table__
+    connection.execute(
+        daily.delete().where(daily.c.category_id == target.id)
+    )
+
+def rebuild_category_closure():
+    """Recompute the categories closure from scratch"""
+    parents = dict(db.session.query(Category.id, Category.parent_id))
+    links = []
+    for categoryid in parents:
+        ancestorid = categoryid
+        depth = 0
+        # "depth <= len(parents)" protects against loops in the hierarchy
+        while ancestorid and depth <= len(parents):
+            links.append({
+                'ancestor_id': ancestorid,
+                'descendant_id': categoryid,
+                'depth': depth
+            })
+            ancestorid = parents.get(ancestorid)
+            depth = depth + 1
+    db.session.execute(CategoryClosure.__table__.delete())
+    if links:
+        db.session.execute(CategoryClosure.__table__.insert(), links)
+    db.session.commit()
+
+
 
 class Transaction(db.Model):
     id                   = db.Column(db.Integer, primary_key=True)
@@ -277,6 +681,12 @@ class Transaction(db.Model):
                                      nullable=False)
     date                 = db.Column(db.Date, nullable=False)
 
+    __table_args__ = (
+        # Transactions are listed by date then id, from the most recent
+        db.Index('ix_transaction_owner_date_id',
+                 'owner_username', 'date', 'id'),
+    )
+
     currency = db.relationship('Currency')
 
     def as_dict(self, username):
@@ -295,6 +705,118 @@ class Transaction(db.Model):
 
 
 
+class TransactionWord(db.Model):
+    """
+    Words of the descriptions of a transaction, for full-text search (works
+    with any database backend)
+    """
+    transaction_id = db.Column(db.ForeignKey('transaction.id',
+                                             ondelete='CASCADE'),
+                               primary_key=True)
+    word           = db.Column(db.String(50), primary_key=True)
+    # Number of occurrences of the word in the descriptions
+    count          = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_transaction_word_word', 'word', 'transaction_id'),
+    )
+
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def search_terms(text):
+    """Return the distinct lowercase words of a text"""
+    return sorted(set([word[:50] for word in WORD.findall(text.lower())]))
+
+def description_words(transactionid, description, original_description):
+    """Return the TransactionWord rows of the descriptions of a transaction"""
+    counts = {}
+    for text in set([description, original_description]):
+        for word in WORD.findall(text.lower()):
+            word = word[:50]
+            counts[word] = counts.get(word, 0) + 1
+    return [
+        {'transaction_id': transactionid, 'word': word, 'count': count}
+        for word, count in counts.items()
+    ]
+
+def index_transaction(connection, transactionid, description,
+                      original_description, reindex=False):
+    words = TransactionWord.__table__
+    if reindex:
+        connection.execute(
+            words.delete().where(words.c.transaction_id == transactionid)
+        )
+    rows = description_words(transactionid, description, original_description)
+    if rows:
+        connection.execute(words.insert(), rows)
+
+@event.listens_for(Transaction, 'after_insert')
+def transaction_inserted(mapper, connection, target):
+    index_transaction(connection, target.id, target.description,
+                      target.original_description)
+
+@event.listens_for(Transaction, 'after_update')
+def transaction_updated(mapper, connection, target):
+    if get_history(target, 'description').has_changes() or \
+       get_history(target, 'original_description').has_changes():
+        index_transaction(connection, target.id, target.description,
+                          target.original_description, reindex=True)
+
+@event.listens_for(Transaction, 'after_delete')
+def transaction_deleted(mapper, connection, target):
+    words = TransactionWord.__table__
+    connection.execute(
+        words.delete().where(words.c.transaction_id == target.id)
+    )
+
+def search_matches(terms):
+    """Select the ids of transactions containing all the given words"""
+    return db.select([TransactionWord.transaction_id]).where(
+                TransactionWord.word.in_(terms)
+           ).group_by(
+                TransactionWord.transaction_id
+           ).having(
+                db.func.count(TransactionWord.word) == len(terms)
+           )
+
+def search_score(terms):
+    """
+    Score of a transaction for the given words (number of occurrences), to be
+    used in a query on transactions
+    """
+    return db.select([db.func.sum(TransactionWord.count)]).where(
+                db.and_(
+                    TransactionWord.transaction_id == Transaction.id,
+                    TransactionWord.word.in_(terms)
+                )
+           ).as_scalar()
+
+def rebuild_transaction_words():
+    """Recompute the words of all transactions from scratch"""
+    db.session.execute(TransactionWord.__table__.delete())
+    lastid = 0
+    while True:
+        transactions = db.session.query(
+                            Transaction.id,
+                            Transaction.description,
+                            Transaction.original_description
+                       ).filter(
+                            Transaction.id > lastid
+                       ).order_by(Transaction.id).limit(500).all()
+        if not transactions:
+            break
+        rows = []
+        for transactionid, description, original_description in transactions:
+            rows.extend(description_words(transactionid, description,
+                                          original_description))
+        if rows:
+            db.session.execute(TransactionWord.__table__.insert(), rows)
+        lastid = transactions[-1][0]
+    db.session.commit()
+
+
+
 class TransactionAccount(db.Model):
     transaction_id = db.Column(db.ForeignKey('transaction.id',
                                              ondelete='CASCADE'),
@@ -320,6 +842,129 @@ class TransactionAccount(db.Model):
         return (self.account_id, self.amount)
 
 
+# Account balances maintenance
+#
+# Each insertion, modification or deletion of a TransactionAccount updates the
+# "transactions_sum" and "transactions_count" columns of its account, within
+# the same flush (and therefore the same database transaction)
+
+def update_account_balance(connection, accountid, amount, count):
+    account = Account.__table__
+    connection.execute(
+        account.update().where(
+            account.c.id == accountid
+        ).values(
+            transactions_sum = account.c.transactions_sum + amount,
+            transactions_count = account.c.transactions_count + count
+        )
+    )
+
+# Differences of accounts balances during a flush, by session, added to the
+# total balances after the flush (see "totals_flushed")
+pending_differences = weakref.WeakKeyDictionary()
+
+def add_pending_difference(target, accountid, amount):
+    differences = pending_differences.setdefault(object_session(target), {})
+    differences[accountid] = differences.get(accountid, 0) + amount
+
+@event.listens_for(TransactionAccount, 'after_insert')
+def transactionaccount_inserted(mapper, connection, target):
+    amount = Decimal(str(target.amount))
+    update_account_balance(connection, target.account_id, amount, 1)
+    add_pending_difference(target, target.account_id, amount)
+
+@event.listens_for(TransactionAccount, 'after_update')
+def transactionaccount_updated(mapper, connection, target):
+    history = get_history(target, 'amount')
+    if history.added and history.deleted:
+        difference = Decimal(str(history.added[0])) - \
+                     Decimal(str(history.deleted[0]))
+        if difference:
+            update_account_balance(connection, target.account_id,
+                                   difference, 0)
+            add_pending_difference(target, target.account_id, difference)
+
+@event.listens_for(TransactionAccount, 'after_delete')
+def transactionaccount_deleted(mapper, connection, target):
+    # Also called for orphans, removed from "transaction_accounts"
+    amount = Decimal(str(target.amount))
+    update_account_balance(connection, target.account_id, -amount, -1)
+    add_pending_difference(target, target.account_id, -amount)
+
+def rebuild_account_balances():
+    """Recompute all accounts balances from scratch"""
+    account = Account.__table__
+    transactionaccount = TransactionAccount.__table__
+    db.session.execute(
+        account.update().values(
+            transactions_sum = db.select([
+                db.func.coalesce(db.func.sum(transactionaccount.c.amount), 0)
+            ]).where(
+                transactionaccount.c.account_id == account.c.id
+            ).as_scalar(),
+            transactions_count = db.select([
+                db.func.count(transactionaccount.c.transaction_id)
+            ]).where(
+                transactionaccount.c.account_id == account.c.id
+            ).as_scalar()
+        )
+    )
+    user = coremodels.User.__table__
+    connection = db.session.connection()
+    ratesversion = exchangerate.version()
+    for (username,) in connection.execute(
+                            db.select([user.c.username])).fetchall():
+        connection.execute(
+            user.update().where(
+                user.c.username == username
+            ).values(
+                total_balance = compute_total_balance(connection, username),
+                total_balance_rates = ratesversion
+            )
+        )
+    db.session.commit()
+
+@event.listens_for(Session, 'after_flush')
+def totals_flushed(session, flush_context):
+    # TransactionAccount differences come from the mapper events above
+    differences = pending_differences.pop(session, {})
+    accountids = set()
+    usernames = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Account) and obj in session.dirty:
+            if get_history(obj, 'currency_id').has_changes():
+                accountids.add(obj.id)
+            else:
+                balances = get_history(obj, 'start_balance')
+                if balances.added and balances.deleted:
+                    difference = Decimal(str(balances.added[0])) - \
+                                 Decimal(str(balances.deleted[0]))
+                    differences[obj.id] = differences.get(obj.id, 0) + \
+                                          difference
+        elif isinstance(obj, AccountOwner):
+            usernames.add(obj.owner_username)
+        elif isinstance(obj, coremodels.Currency) and obj.owner_username:
+            usernames.add(obj.owner_username)
+        elif isinstance(obj, coremodels.User) and \
+             get_history(obj, 'preferred_currency_id').has_changes():
+            usernames.add(obj.username)
+    add_to_total_balances(session, differences)
+    if accountids:
+        owner = AccountOwner.__table__
+        usernames.update([
+            row[0] for row in session.connection().execute(
+                db.select([owner.c.owner_username]).where(
+                    owner.c.account_id.in_(accountids)
+                )
+            )
+        ])
+    invalidate_total_balances(session, usernames)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def totals_rolled_back(session, previous_transaction):
+    pending_differences.pop(session, None)
+
+
 
 class TransactionCategory(db.Model):
     transaction_id     = db.Column(db.ForeignKey('transaction.id',
@@ -352,3 +997,247 @@ class TransactionCategory(db.Model):
                 'category_amount': self.category_amount
             }
         )
+
+
+
+class CategoryDailyBalance(db.Model):
+    """
+    Sum of the amounts of a category for one day
+
+    Maintained after each flush (see "update_category_daily_balances").
+    """
+    category_id = db.Column(db.ForeignKey('category.id', ondelete='CASCADE'),
+                            primary_key=True)
+    day         = db.Column(db.Date, primary_key=True)
+    amount      = db.Column(db.Numeric(15, 3), nullable=False)
+
+
+# Categories daily balances maintenance
+#
+# After each flush, the days and categories touched by new, modified or
+# deleted TransactionCategory objects (or by transactions whose date has
+# changed) are summed again. Only the touched categories are recalculated,
+# on the touched days.
+
+def history_values(obj, attribute):
+    """Return the current and previous values of an attribute"""
+    history = get_history(obj, attribute)
+    # History members may be lists or tuples, which cannot be added together
+    return set(list(history.added) + list(history.unchanged) +
+               list(history.deleted))
+
+def transaction_days(transaction):
+    """Return the current and previous dates of a transaction"""
+    return history_values(transaction, 'date')
+
+# Dates recalculated per statement (SQLite accepts 999 parameters at most)
+DAILY_BALANCES_CHUNK = 500
+
+def update_category_daily_balances(connection, days):
+    """
+    Sum again the given (<category id>, <date>) days
+
+    All the touched categories are recalculated on all the touched dates with
+    three statements (one SELECT of the sums, one DELETE and one executemany
+    INSERT) per DAILY_BALANCES_CHUNK dates, whatever the number of days.
+    """
+    daily = CategoryDailyBalance.__table__
+    transactioncategory = TransactionCategory.__table__
+    transaction = Transaction.__table__
+    categoryids = list(set([categoryid for categoryid, day in days]))
+    dates = sorted(set([day for categoryid, day in days]))
+    for index in range(0, len(dates), DAILY_BALANCES_CHUNK):
+        chunk = dates[index:index+DAILY_BALANCES_CHUNK]
+        sums = connection.execute(
+            db.select([
+                transactioncategory.c.category_id,
+                transaction.c.date,
+                db.func.sum(transactioncategory.c.category_amount)
+            ]).where(
+                db.and_(
+                    transactioncategory.c.category_id.in_(categoryids),
+                    transactioncategory.c.transaction_id == transaction.c.id,
+                    transaction.c.date.in_(chunk)
+                )
+            ).group_by(
+                transactioncategory.c.category_id,
+                transaction.c.date
+            )
+        ).fetchall()
+        connection.execute(
+            daily.delete().where(
+                db.and_(
+                    daily.c.category_id.in_(categoryids),
+                    daily.c.day.in_(chunk)
+                )
+            )
+        )
+        rows = [
+            {'category_id': categoryid, 'day': day, 'amount': amount}
+            for categoryid, day, amount in sums
+            if amount
+        ]
+        if rows:
+            connection.execute(daily.insert(), rows)
+
+@event.listens_for(Session, 'after_flush')
+def categories_flushed(session, flush_context):
+    days = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, TransactionCategory):
+            # Splits removed from "transaction_categories" are orphans (no
+            # transaction anymore): their former transaction is in the history
+            for transaction in history_values(obj, 'transaction'):
+                if transaction is None:
+                    continue
+                for day in transaction_days(transaction):
+                    for categoryid in history_values(obj, 'category_id'):
+                        if categoryid is not None:
+                            days.add((categoryid, day))
+        elif isinstance(obj, Transaction) and obj not in session.deleted:
+            history = get_history(obj, 'date')
+            if history.added and history.deleted:
+                for tc in obj.transaction_categories:
+                    for day in transaction_days(obj):
+                        days.add((tc.category_id, day))
+    if days:
+        update_category_daily_balances(session.connection(), days)
+        invalidate_balances(session, set([c for c, d in days]))
+
+def rebuild_category_daily_balances():
+    """Recompute all categories daily balances from scratch"""
+    sums = db.session.query(
+        TransactionCategory.category_id,
+        Transaction.date,
+        db.func.sum(TransactionCategory.category_amount)
+    ).filter(
+        TransactionCategory.transaction_id == Transaction.id
+    ).group_by(
+        TransactionCategory.category_id,
+        Transaction.date
+    ).all()
+    db.session.execute(CategoryDailyBalance.__table__.delete())
+    if sums:
+        db.session.execute(CategoryDailyBalance.__table__.insert(), [
+            {'category_id': categoryid, 'day': day, 'amount': amount}
+            for categoryid, day, amount in sums
+        ])
+    db.session.commit()
+
+
+
+# Categories balances cache
+#
+# Balances of a category are cached under a key made of versions: the version
+# of the category (incremented when its transactions, itself or any of its
+# children change), the version of its owner's currencies, the exchange rates
+# version and the current date. So they never have to be deleted and may be
+# cached for hours, if the cache is shared by all workers (with a cache local
+# to each process, a worker does not see the versions incremented by the other
+# ones: balances are then only cached for a minute).
+#
+# Versions are incremented after the commit of the changes: a balance computed
+# from data which is not committed yet is never stored under a new version.
+
+if is_shared(cache):
+    BALANCE_CACHE_DURATION = 6 * 3600
+else:
+    # Versions incremented by a worker are not seen by the other ones
+    BALANCE_CACHE_DURATION = 60
+VERSION_CACHE_DURATION = 7 * 24 * 3600
+
+# {<session>: {'categories': set(<ids>), 'usernames': set(<usernames>)}}
+pending_invalidations = weakref.WeakKeyDictionary()
+
+def category_version_key(categoryid):
+    return 'categoryversion-{0}'.format(categoryid)
+
+def currencies_version_key(username):
+    return u'currenciesversion-{0}'.format(username)
+
+def cache_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the current time, so an evicted version does not go back
+        # to a previous value
+        cache.add(key, int(time.time() * 1000), VERSION_CACHE_DURATION)
+        version = cache.get(key)
+    return version
+
+def bump_version(key):
+    if cache.get(key) is None:
+        cache_version(key)
+    else:
+        cache.inc(key)
+
+def balance_keys(username, categories):
+    """Return the {<category id>: <balance cache key>} of categories"""
+    suffix = u'-{0}-{1}-{2}'.format(
+                cache_version(currencies_version_key(username)),
+                exchangerate.version(),
+                datetime.date.today().toordinal()
+             )
+    return dict([
+        (c.id, u'categorybalance-{0}-{1}{2}'.format(
+                    c.id, cache_version(category_version_key(c.id)), suffix
+               )) for c in categories
+    ])
+
+def invalidate_balances(session, categoryids=(), usernames=()):
+    """
+    Invalidate the balances of categories (and their parents) and of all
+    categories of users, when the session is committed
+    """
+    if hasattr(session, 'registry'):
+        # Scoped session (db.session): the listeners receive the real session
+        session = session()
+    pending = pending_invalidations.setdefault(
+                    session, {'categories': set(), 'usernames': set()}
+              )
+    categoryids = set(categoryids) - pending['categories']
+    if categoryids:
+        closure = CategoryClosure.__table__
+        pending['categories'].update(categoryids)
+        pending['categories'].update([
+            row[0] for row in session.connection().execute(
+                db.select([closure.c.ancestor_id]).where(
+                    closure.c.descendant_id.in_(categoryids)
+                )
+            )
+        ])
+    pending['usernames'].update(usernames)
+
+@event.listens_for(Session, 'after_flush')
+def balances_flushed(session, flush_context):
+    categoryids = set()
+    usernames = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Category):
+            categoryids.add(obj.id)
+            # Previous parents, if the category was moved or deleted
+            categoryids.update(get_history(obj, 'parent_id').deleted)
+            categoryids.add(obj.parent_id)
+        elif isinstance(obj, TransactionCategory):
+            categoryids.add(obj.category_id)
+            categoryids.update(get_history(obj, 'category_id').deleted)
+        elif isinstance(obj, coremodels.Currency) and obj.owner_username:
+            usernames.add(obj.owner_username)
+        elif isinstance(obj, coremodels.User) and \
+             get_history(obj, 'preferred_currency_id').has_changes():
+            usernames.add(obj.username)
+    categoryids.discard(None)
+    if categoryids or usernames:
+        invalidate_balances(session, categoryids, usernames)
+
+@event.listens_for(Session, 'after_commit')
+def balances_committed(session):
+    pending = pending_invalidations.pop(session, None)
+    if pending:
+        for categoryid in pending['categories']:
+            bump_version(category_version_key(categoryid))
+        for username in pending['usernames']:
+            bump_version(currencies_version_key(username))
+
+@event.listens_for(Session, 'after_soft_rollback')
+def balances_rolled_back(session, previous_transaction):
+    pending_invalidations.pop(session, None)
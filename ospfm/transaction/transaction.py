@@ -15,19 +15,21 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-import datetime, json
+import base64, datetime, json
 
-from flask import jsonify
+from flask import Response, jsonify, request, stream_with_context
 
 from ospfm import db, helpers
 from ospfm.core import currency
 from ospfm.core import models as core
-from ospfm.transaction import models
+from ospfm.transaction import exporter, importer, models
 from ospfm.objects import Object
 
 
 class Transaction(Object):
 
+    cacheable = True
+
     def __own_transaction(self, transactionid):
         return models.Transaction.query.options(
                           db.joinedload(models.Transaction.currency),
@@ -40,6 +42,39 @@ class Transaction(Object):
                     )
                ).first()
 
+    def __own_accounts(self, accountids):
+        """
+        Return the {<id>: <account>} dictionary of the given accounts owned by
+        the user, with a single request
+        """
+        accountids = set([object_id(i) for i in accountids]) - set([None])
+        if not accountids:
+            return {}
+        return dict([(a.id, a) for a in models.Account.query.join(
+                            models.AccountOwner
+                        ).filter(
+                            db.and_(
+                                models.AccountOwner.owner_username == \
+                                                                self.username,
+                                models.Account.id.in_(accountids)
+                            )
+                        )])
+
+    def __own_categories(self, categoryids):
+        """
+        Return the {<id>: <category>} dictionary of the given categories owned
+        by the user, with a single request
+        """
+        categoryids = set([object_id(i) for i in categoryids]) - set([None])
+        if not categoryids:
+            return {}
+        return dict([(c.id, c) for c in models.Category.query.filter(
+                            db.and_(
+                                models.Category.owner_username == self.username,
+                                models.Category.id.in_(categoryids)
+                            )
+                        )])
+
     def list(self):
         # Transactions cannot be listed with the API
         self.forbidden('Listing all transactions is forbidden')
@@ -54,15 +89,7 @@ class Transaction(Object):
             self.badrequest(
            "Please provide transaction description, currency, amount and date")
         # First, create the transaction object
-        currency = core.Currency.query.filter(
-            db.and_(
-                core.Currency.isocode == self.args['currency'],
-                db.or_(
-                    core.Currency.owner_username == self.username,
-                    core.Currency.owner_username == None
-                )
-            )
-        ).first()
+        currency = core.find_currency(self.username, self.args['currency'])
         if not currency:
             self.badrequest("This currency does not exist")
         date = helpers.date_from_string(self.args['date'])
@@ -78,7 +105,7 @@ class Transaction(Object):
             description = description,
             original_description = original_description,
             amount = self.args['amount'],
-            currency = currency,
+            currency_id = currency.id,
             date = date
         )
         db.session.add(transaction)
@@ -86,59 +113,47 @@ class Transaction(Object):
         # Next, create the links from the transaction to its accounts
         if 'accounts' in self.args:
             accounts = json.loads(self.args['accounts'])
+            accountobjects = self.__own_accounts(
+                                [a.get('account') for a in accounts])
             for accountdata in accounts:
-                transaction_accounts = []
                 if 'amount' in accountdata:
                     # If no amount is specified, do not associate the account
-                    accountobject = models.Account.query.options(
-                        db.joinedload(models.Account.account_owners)
-                    ).filter(
-                        db.and_(
-                           models.Account.id == accountdata['account'],
-                           models.AccountOwner.owner_username == self.username,
-                        )
-                    ).first()
-                    if accountobject:
-                        ta = models.TransactionAccount(
-                                transaction = transaction,
-                                account = accountobject,
+                    accountid = object_id(accountdata.get('account'))
+                    if accountid in accountobjects:
+                        transaction.transaction_accounts.append(
+                            models.TransactionAccount(
+                                account = accountobjects[accountid],
                                 amount = accountdata['amount'],
                                 verified = False
+                            )
                         )
-                        db.session.add(ta)
                     self.add_to_response('accountbalance',
-                                         accountdata['account'])
+                                         accountdata.get('account'))
             self.add_to_response('totalbalance')
 
         # Next, create the links from the transaction to its categories
         if 'categories' in self.args:
             categories = json.loads(self.args['categories'])
+            categoryobjects = self.__own_categories(
+                                [c.get('category') for c in categories])
             for categorydata in categories:
-                transaction_categories = []
                 if 'transaction_amount' in categorydata and \
                    'category_amount' in categorydata:
                     # If no amount is specified, do not associate the category
-                    categoryobject = models.Category.query.options(
-                        db.joinedload(models.Category.currency)
-                    ).filter(
-                        db.and_(
-                            models.Category.id == categorydata['category'],
-                            models.Category.owner_username == self.username,
-                        )
-                    ).first()
-                    if categoryobject:
-                        tc = models.TransactionCategory(
-                                transaction = transaction,
-                                category = categoryobject,
+                    categoryid = object_id(categorydata.get('category'))
+                    if categoryid in categoryobjects:
+                        transaction.transaction_categories.append(
+                            models.TransactionCategory(
+                                category = categoryobjects[categoryid],
                        transaction_amount = categorydata['transaction_amount'],
                               category_amount = categorydata['category_amount']
+                            )
                         )
-                        db.session.add(tc)
                     self.add_to_response('categoriesbalance',
-                                         categorydata['category'])
+                                         categorydata.get('category'))
 
         # Commit everything...
-        db.session.commit()
+        self.commit()
         return transaction.as_dict(self.username)
 
     def read(self, transactionid):
@@ -163,133 +178,103 @@ class Transaction(Object):
         if 'amount' in self.args:
             transaction.amount = self.args['amount']
         if 'currency' in self.args:
-            currency = core.Currency.query.filter(
-                db.and_(
-                    core.Currency.isocode == self.args['currency'],
-                    db.or_(
-                        core.Currency.owner_username == self.username,
-                        core.Currency.owner_username == None
-                    )
-                )
-            ).first()
+            currency = core.find_currency(self.username, self.args['currency'])
             if currency:
-                transaction.currency = currency
+                transaction.currency_id = currency.id
         if 'date' in self.args:
             date = helpers.date_from_string(self.args['date'])
             if date:
                 transaction.date = date
 
         # Next, update accounts
+        # Links are compared to the already loaded ones, new accounts are
+        # requested at once
         if 'accounts' in self.args:
-            existing_accounts = dict([ta.as_tuple() for ta in
+            existing_accounts = dict([(ta.account_id, ta) for ta in
                                       transaction.transaction_accounts])
-            new_accounts_data = json.loads(self.args['accounts'])
+            new_accounts_data = [
+                a for a in json.loads(self.args['accounts'])
+                if 'amount' in a and object_id(a.get('account')) is not None
+            ]
+            accountobjects = self.__own_accounts([
+                a['account'] for a in new_accounts_data
+                if object_id(a['account']) not in existing_accounts
+            ])
+            keep_accounts = set()
             for account_data in new_accounts_data:
-                if 'amount' in account_data and 'account' in account_data:
-                    amount = account_data['amount']
-                    accountid = account_data['account']
-                    if accountid in existing_accounts.keys():
-                        # Account already linked...
-                        if existing_accounts[accountid] != amount:
-                            # ...but the amount is different
-                            ta = models.TransactionAccount.query.filter(db.and_(
-                          models.TransactionAccount.transaction == transaction,
-                          models.TransactionAccount.account_id == accountid
-                            )).one()
-                            ta.amount = amount
-                            ta.verified = False
-                            self.add_to_response('accountbalance', accountid)
-                        existing_accounts.pop(accountid)
-                    else:
-                        # Account is not already linked
-                        # Verify the account is owned by the user
-                        accountobject = models.Account.query.options(
-                            db.joinedload(models.Account.account_owners)
-                        ).filter(
-                          db.and_(
-                            models.Account.id == accountid,
-                            models.AccountOwner.owner_username == self.username
-                         )
-                        ).first()
-                        if accountobject:
-                            ta = models.TransactionAccount(
-                                    transaction = transaction,
-                                    account = accountobject,
-                                    amount = amount,
-                                    verified = False
-                            )
-                            self.add_to_response('accountbalance', accountid)
-                            db.session.add(ta)
-            # All accounts to keep have been poped out from "existing_accounts"
-            # Delete all links remaining from this transaction to accounts
-            for accountid in existing_accounts.keys():
-                ta = models.TransactionAccount.query.filter(db.and_(
-                    models.TransactionAccount.transaction == transaction,
-                    models.TransactionAccount.account_id == accountid
-                )).one()
-                self.add_to_response('accountbalance', accountid)
-                db.session.delete(ta)
+                amount = account_data['amount']
+                accountid = object_id(account_data['account'])
+                if accountid in existing_accounts:
+                    # Account already linked...
+                    ta = existing_accounts[accountid]
+                    if ta.amount != amount:
+                        # ...but the amount is different
+                        ta.amount = amount
+                        ta.verified = False
+                        self.add_to_response('accountbalance', accountid)
+                    keep_accounts.add(accountid)
+                elif accountid in accountobjects:
+                    # Account is not already linked (and owned by the user)
+                    transaction.transaction_accounts.append(
+                        models.TransactionAccount(
+                            account = accountobjects.pop(accountid),
+                            amount = amount,
+                            verified = False
+                        )
+                    )
+                    self.add_to_response('accountbalance', accountid)
+            # Delete all links from this transaction to accounts not given
+            for accountid, ta in existing_accounts.items():
+                if accountid not in keep_accounts:
+                    transaction.transaction_accounts.remove(ta)
+                    self.add_to_response('accountbalance', accountid)
 
             self.add_to_response('totalbalance')
 
-        # Then, update categories
+        # Then, update categories, the same way
         if 'categories' in self.args:
-            existing_categories = dict([tc.as_tuple() for tc in
+            existing_categories = dict([(tc.category_id, tc) for tc in
                                         transaction.transaction_categories])
-            new_categories_data = json.loads(self.args['categories'])
+            new_categories_data = [
+                c for c in json.loads(self.args['categories'])
+                if 'transaction_amount' in c and 'category_amount' in c and
+                   object_id(c.get('category')) is not None
+            ]
+            categoryobjects = self.__own_categories([
+                c['category'] for c in new_categories_data
+                if object_id(c['category']) not in existing_categories
+            ])
+            keep_categories = set()
             for category_data in new_categories_data:
-                if 'transaction_amount' in category_data and \
-                   'category_amount' in category_data and \
-                   'category' in category_data:
-                    transaction_amount = category_data['transaction_amount']
-                    category_amount = category_data['category_amount']
-                    categoryid = category_data['category']
-                    if categoryid in existing_categories.keys():
-                        # Category already linked...
-                        if existing_categories[categoryid]['category_amount'] \
-                           != category_amount:
-                            # ...but the amount is different
-                            tc = models.TransactionCategory.query.filter(db.and_(
-                         models.TransactionCategory.transaction == transaction,
-                         models.TransactionCategory.category_id == categoryid
-                            )).one()
-                            tc.transaction_amount = transaction_amount
-                            tc.category_amount = category_amount
-                            tc.verified = False
-                            self.add_to_response('categoriesbalance',
-                                                 categoryid)
-                        existing_categories.pop(categoryid)
-                    else:
-                        # Category is not already linked
-                        # Verify the category is owned by the user
-                        categoryobject = models.Category.query.filter(
-                          db.and_(
-                           models.Category.id == categoryid,
-                           models.Category.owner_username == self.username
-                         )
-                        ).first()
-                        if categoryobject:
-                            tc = models.TransactionCategory(
-                                    transaction = transaction,
-                                    category = categoryobject,
-                                    transaction_amount = transaction_amount,
-                                    category_amount = category_amount
-                            )
-                            self.add_to_response('categoriesbalance',
-                                                 categoryid)
-                            db.session.add(tc)
-            # All categories to keep have been poped out from
-            # "existing_categories"
-            # Delete all links remaining from this transaction to categories
-            for categoryid in existing_categories.keys():
-                tc = models.TransactionCategory.query.filter(db.and_(
-                    models.TransactionCategory.transaction == transaction,
-                    models.TransactionCategory.category_id == categoryid
-                )).one()
-                self.add_to_response('categoriesbalance', categoryid)
-                db.session.delete(tc)
+                transaction_amount = category_data['transaction_amount']
+                category_amount = category_data['category_amount']
+                categoryid = object_id(category_data['category'])
+                if categoryid in existing_categories:
+                    # Category already linked...
+                    tc = existing_categories[categoryid]
+                    if tc.category_amount != category_amount:
+                        # ...but the amount is different
+                        tc.transaction_amount = transaction_amount
+                        tc.category_amount = category_amount
+                        self.add_to_response('categoriesbalance', categoryid)
+                    keep_categories.add(categoryid)
+                elif categoryid in categoryobjects:
+                    # Category is not already linked (and owned by the user)
+                    transaction.transaction_categories.append(
+                        models.TransactionCategory(
+                            category = categoryobjects.pop(categoryid),
+                            transaction_amount = transaction_amount,
+                            category_amount = category_amount
+                        )
+                    )
+                    self.add_to_response('categoriesbalance', categoryid)
+            # Delete all links from this transaction to categories not given
+            for categoryid, tc in existing_categories.items():
+                if categoryid not in keep_categories:
+                    transaction.transaction_categories.remove(tc)
+                    self.add_to_response('categoriesbalance', categoryid)
 
-        db.session.commit()
+        self.commit()
         return transaction.as_dict(self.username)
 
     def delete(self, transactionid):
@@ -303,18 +288,131 @@ class Transaction(Object):
         for tc in transaction.transaction_categories:
             self.add_to_response('categoriesbalance', tc.category_id)
         db.session.delete(transaction)
-        db.session.commit()
+        self.commit()
 
     def http_filter(self):
         self._Object__init_http()
-        return jsonify(status=200, response=self.__filter(self.args))
+        transactions, cursor = self.__filter(self.args)
+        return jsonify(status=200, response=transactions, next=cursor)
+
+    def http_import(self):
+        """Import transactions from an uploaded CSV, OFX or QIF file"""
+        self._Object__init_http()
+        if not ('format' in self.args and 'account' in self.args and
+                'file' in request.files):
+            self.badrequest("Please provide the file, its format and account")
+        if self.args['format'] not in importer.parsers:
+            self.badrequest("This file format is not supported")
+        account = models.Account.query.options(
+                        db.joinedload(models.Account.currency)
+                  ).join(models.AccountOwner).filter(
+                        db.and_(
+                           models.AccountOwner.owner_username == self.username,
+                           models.Account.id == self.args['account']
+                        )
+                  ).first()
+        if not account:
+            self.badrequest("This account does not exist")
+        if 'category' in self.args:
+            category = models.Category.query.options(
+                            db.joinedload(models.Category.currency)
+                       ).filter(
+                            db.and_(
+                               models.Category.owner_username == self.username,
+                               models.Category.id == self.args['category']
+                            )
+                       ).first()
+            if not category:
+                self.badrequest("This category does not exist")
+        else:
+            category = None
+        parser = importer.parsers[self.args['format']]
+        try:
+            count = importer.import_transactions(
+                        self.username,
+                        parser(request.files['file'].stream),
+                        account,
+                        category
+                    )
+        except importer.ImportFormatError, e:
+            db.session.rollback()
+            self.badrequest(str(e))
+        core.bump_data_version(self.username)
+        db.session.commit()
+        self.add_to_response('accountbalance', account.id)
+        self.add_to_response('totalbalance')
+        if category:
+            self.add_to_response('categoriesbalance', category.id)
+        return self._Object__response({'imported': count})
+
+    def http_export(self):
+        """Stream all transactions of the user, as NDJSON or CSV"""
+        self._Object__init_http()
+        format = self.args.get('format', 'ndjson')
+        if format not in exporter.formatters:
+            self.badrequest("This export format is not supported")
+        response = Response(
+            stream_with_context(
+                exporter.export_transactions(self.username, format)
+            ),
+            mimetype=exporter.formatters[format][1]
+        )
+        response.headers['Content-Disposition'] = \
+                        'attachment; filename=transactions.{0}'.format(format)
+        return response
+
+    def __position(self, after, score=None):
+        """
+        Return the (date, id) position of the given cursor or transaction id,
+        followed by the search score of the transaction if a score is given
+        (None if the cursor is invalid)
+        """
+        if not after.isdigit():
+            position = cursor_position(after)
+            if position and score is None:
+                return position[:2]
+            if position and len(position) == 3:
+                return position
+            # Not a search cursor, while searching
+            return None
+        # Transaction id
+        columns = [models.Transaction.date, models.Transaction.id]
+        if score is not None:
+            columns.append(score)
+        position = db.session.query(*columns).filter(
+                        db.and_(
+                            models.Transaction.owner_username == self.username,
+                            models.Transaction.id == int(after)
+                        )
+                   ).first()
+        if position and (score is None or position[2] is not None):
+            return tuple(position)
+        return None
 
     def __filter(self, filter):
+        """
+        Return a page of transactions, from the most recent (or, when
+        searching, from the best match), and the cursor to give as "after" to
+        get the next page (None on the last page)
+
+        Pages are found by seeking the (date, id) position of the cursor (and
+        its search score) instead of counting transactions, so the depth of a
+        page does not change its cost.
+        """
         filters = [
             models.Transaction.owner_username == self.username,
         ]
+        order = [
+            db.desc(models.Transaction.date),
+            db.desc(models.Transaction.id)
+        ]
+        terms = models.search_terms(filter.get('search', ''))
+        if terms:
+            score = models.search_score(terms)
+            order.insert(0, db.desc(score))
+        else:
+            score = None
         limit = 100
-        after = False
         for part in filter.items():
             if part[0] in filter_functions:
                 filters.extend(
@@ -326,50 +424,92 @@ class Transaction(Object):
                 except:
                     pass
             elif part[0] == 'after':
-                try:
-                    after = int(part[1])
-                except:
-                    pass
-        if after:
-            # Get offset of the "from" transaction
-            # XXX: Is there a more efficient way to do so ?
-            all_transactions = db.session.query(models.Transaction.id).order_by(
-                                db.desc(models.Transaction.date)
-                           ).filter(
-                                db.and_(
-                                    *filters
-                                )
-                           )
-            all_ids = [t.id for t in all_transactions]
-            try:
-                offset = all_ids.index(after) + 1
-            except:
-                offset = 0
-            transactions = models.Transaction.query.options(
-                        db.joinedload(models.Transaction.currency),
-                        db.joinedload(models.Transaction.transaction_accounts),
-                        db.joinedload(models.Transaction.transaction_categories)
-                    ).order_by(
-                        db.desc(models.Transaction.date)
-                    ).filter(
-                        db.and_(
-                            *filters
+                position = self.__position(part[1], score)
+                if not position:
+                    self.badrequest("This cursor is invalid")
+                if score is None:
+                    filters.append(after_filter(*position))
+                else:
+                    date, transactionid, value = position
+                    filters.append(
+                        db.or_(
+                            score < value,
+                            db.and_(
+                                score == value,
+                                after_filter(date, transactionid)
+                            )
                         )
-                    ).offset(offset).limit(limit)
-            return [t.as_dict(self.username) for t in transactions]
+                    )
+        query = db.session.query(models.Transaction)
+        if score is not None:
+            # The score of the last transaction is needed for the cursor
+            query = query.add_column(score)
+        rows = query.options(
+                    db.joinedload(models.Transaction.currency),
+                    db.joinedload(models.Transaction.transaction_accounts),
+                    db.joinedload(models.Transaction.transaction_categories)
+                ).order_by(
+                    *order
+                ).filter(
+                    db.and_(
+                        *filters
+                    )
+                ).limit(limit).all()
+        if score is None:
+            transactions = rows
         else:
-            transactions = models.Transaction.query.options(
-                        db.joinedload(models.Transaction.currency),
-                        db.joinedload(models.Transaction.transaction_accounts),
-                        db.joinedload(models.Transaction.transaction_categories)
-                    ).order_by(
-                        db.desc(models.Transaction.date)
-                    ).filter(
-                        db.and_(
-                            *filters
-                        )
-                    ).limit(limit)
-            return [t.as_dict(self.username) for t in transactions]
+            transactions = [row[0] for row in rows]
+        if rows and len(rows) == limit:
+            if score is None:
+                cursor = make_cursor(rows[-1])
+            else:
+                cursor = make_cursor(*rows[-1])
+        else:
+            cursor = None
+        return [t.as_dict(self.username) for t in transactions], cursor
+
+def object_id(value):
+    """Return an object id given in JSON data as an integer, or None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def make_cursor(transaction, score=None):
+    """
+    Return an opaque cursor pointing after the given transaction (and its
+    search score, when searching)
+    """
+    position = transaction.date.strftime('%Y-%m-%d'), str(transaction.id)
+    if score is not None:
+        position += (str(int(score)),)
+    return base64.urlsafe_b64encode('/'.join(position)).rstrip('=')
+
+def cursor_position(cursor):
+    """
+    Return the (date, id) position of a cursor, followed by the search score
+    for a search cursor, or None if it is invalid
+    """
+    try:
+        parts = base64.urlsafe_b64decode(
+                    str(cursor) + '=' * (-len(cursor) % 4)
+                ).split('/')
+        date = helpers.date_from_string(parts[0])
+        if date and len(parts) in (2, 3):
+            return (date,) + tuple([int(part) for part in parts[1:]])
+    except:
+        pass
+    return None
+
+def after_filter(date, transactionid):
+    """Only transactions after the (date, id) position, from the most recent"""
+    return db.or_(
+        models.Transaction.date < date,
+        db.and_(
+            models.Transaction.date == date,
+            models.Transaction.id < transactionid
+        )
+    )
 
 def account_filter(value):
     return [
@@ -377,25 +517,33 @@ def account_filter(value):
         models.TransactionAccount.account_id == value
     ]
 def category_filter(value):
-    def subcategories(categoryid, categorylist):
-        for cat in models.Category.query.filter(
-                        models.Category.parent_id == categoryid
-                    ):
-            categorylist.append(cat.id)
-            categorylist = subcategories(cat.id, categorylist)
-        return categorylist
-
-    categorylist = subcategories(value, [ int(value) ])
+    # Transactions in this category or in any of its children (a subquery:
+    # a transaction split in several of these categories is listed once)
+    transactioncategory = models.TransactionCategory.__table__
     return [
-        models.Transaction.id == models.TransactionCategory.transaction_id,
-        db.or_(*[ models.TransactionCategory.category_id == value \
-               for value in categorylist ])
+        models.Transaction.id.in_(
+            db.select([transactioncategory.c.transaction_id]).where(
+                transactioncategory.c.category_id.in_(
+                    db.select([models.CategoryClosure.descendant_id]).where(
+                        models.CategoryClosure.ancestor_id == value
+                    )
+                )
+            )
+        )
     ]
 def currency_filter(value):
     return [
         models.Transaction.currency_id == core.Currency.id,
         core.Currency.isocode == value
     ]
+def search_filter(value):
+    # Transactions containing all the words (ordered by score in __filter)
+    terms = models.search_terms(value)
+    if not terms:
+        return []
+    return [
+        models.Transaction.id.in_(models.search_matches(terms))
+    ]
 def dates_filter(value):
     try:
         f = []
@@ -424,5 +572,6 @@ filter_functions = {
     'account': account_filter,
     'category': category_filter,
     'currency': currency_filter,
-    'dates': dates_filter
+    'dates': dates_filter,
+    'search': search_filter
 }
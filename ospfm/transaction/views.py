@@ -42,3 +42,11 @@ def transactions(transactionid=None):
 @app.route('/transactions/filter')
 def transaction_filter():
     return Transaction().http_filter()
+
+@app.route('/transactions/import', methods=['POST'])
+def transaction_import():
+    return Transaction().http_import()
+
+@app.route('/transactions/export')
+def transaction_export():
+    return Transaction().http_export()
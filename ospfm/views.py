@@ -15,7 +15,9 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-from ospfm import app, authentication, config
+from flask import abort, jsonify, request
+
+from ospfm import app, authentication, config, passwords
 
 if config.DEVEL:
     @app.after_request
@@ -33,6 +35,42 @@ def root():
 def login():
     return authentication.authenticate()
 
+@app.route('/logout', methods=['POST'])
+def logout():
+    return authentication.logout()
+
+@app.route('/login/refresh', methods=['POST'])
+def login_refresh():
+    return authentication.refresh()
+
+@app.route('/login/tokens')
+def login_tokens():
+    return authentication.refresh_tokens()
+
+@app.route('/login/tokens/<int:tokenid>', methods=['POST', 'DELETE'])
+def login_token_revoke(tokenid):
+    return authentication.revoke_refresh_token(tokenid)
+
+def authenticate_admin():
+    """Only let administrators (config.ADMIN_USERNAMES) continue"""
+    username = authentication.get_username_auth(
+                    request.values.get('key', None))
+    if username not in getattr(config, 'ADMIN_USERNAMES', ()):
+        abort(403, 'Only administrators may read statistics')
+
+@app.route('/stats/passwords')
+def passwords_stats():
+    authenticate_admin()
+    return jsonify(status=200, response=passwords.get_stats())
+
+@app.route('/stats/cache')
+def cache_stats():
+    authenticate_admin()
+    if not hasattr(config.CACHE, 'stats'):
+        abort(404, 'The cache does not give statistics')
+    return jsonify(status=200, response=config.CACHE.stats())
+
 from ospfm.core import views
 from ospfm.transaction import views
+import batch
 import wizard
@@ -50,10 +50,36 @@ def delete_everything(username):
     """Delete all data except user preferences"""
     # Transaction
     #  -> TransactionAccount and TransactionCategory deleted by cascade
+    #  -> TransactionWord is not maintained by bulk deletes
+    transaction.TransactionWord.query.filter(
+        transaction.TransactionWord.transaction_id.in_(
+            db.select([transaction.Transaction.id]).where(
+                transaction.Transaction.owner_username == username
+            )
+        )
+    ).delete(synchronize_session=False)
     transaction.Transaction.query.filter(
         transaction.Transaction.owner_username == username
     ).delete()
     # Category
+    #  -> CategoryClosure and CategoryDailyBalance are not maintained by bulk
+    #     deletes
+    usercategories = db.select([transaction.Category.id]).where(
+                        transaction.Category.owner_username == username
+                     )
+    #  -> Their cached balances are invalidated on commit (their ids may be
+    #     used again by new categories)
+    transaction.invalidate_balances(
+        db.session,
+        [row[0] for row in db.session.execute(usercategories)],
+        [username]
+    )
+    transaction.CategoryClosure.query.filter(
+        transaction.CategoryClosure.ancestor_id.in_(usercategories)
+    ).delete(synchronize_session=False)
+    transaction.CategoryDailyBalance.query.filter(
+        transaction.CategoryDailyBalance.category_id.in_(usercategories)
+    ).delete(synchronize_session=False)
     transaction.Category.query.filter(
         transaction.Category.owner_username == username
     ).delete()
@@ -84,8 +110,11 @@ def delete_everything(username):
         core.Currency.owner_username == username
     ).delete()
     # XXX TransactionAccounts are not deleted : problem with SQLite
+    transaction.invalidate_total_balances(db.session, [username])
+    core.bump_data_version(username)
     # Commit deletes
     db.session.commit()
+    helpers.forget_rates(username)
 
 
 
@@ -151,6 +180,7 @@ def create(username, wizard, locale, prefcurrency):
         db.session.add(currency)
         currencies[symbol] = currency
     db.session.commit()
+    helpers.forget_rates(username)
 
     ########## Account
     accounts = {}
@@ -299,7 +329,8 @@ def create(username, wizard, locale, prefcurrency):
             accountamount = amount * helpers.rate(
                                             username,
                                             currency.isocode,
-                                            account.currency.isocode
+                                            account.currency.isocode,
+                                            transactiondate
                                         )
             db.session.add(
                 transaction.TransactionAccount(
@@ -320,7 +351,8 @@ def create(username, wizard, locale, prefcurrency):
             categoryamount = amount * helpers.rate(
                                             username,
                                             currency.isocode,
-                                            category.currency.isocode
+                                            category.currency.isocode,
+                                            transactiondate
                                         )
             db.session.add(
                 transaction.TransactionCategory(
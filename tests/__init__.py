@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of OSPFM, through its HTTP API
+
+They need a configuration (ospfm/config.py, see config.py.template) but use
+their own temporary SQLite database, the development user "alice" and exchange
+rates read from a local file. Run them with "python -m unittest discover".
+"""
+
+import json, os, shutil, tempfile, time, unittest
+
+from ospfm import app, config, db, init_db
+from ospfm.core import exchangerate, models as core
+
+# Rates relative to USD
+RATES = {'USD': 1, 'EUR': 0.8}
+
+
+class OspfmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ospfm-tests-')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+                        os.path.join(self.directory, 'ospfm.sqlite3')
+        app.config['TESTING'] = True
+        ratesfile = os.path.join(self.directory, 'rates.json')
+        with open(ratesfile, 'w') as rates:
+            json.dump({'timestamp': int(time.time()), 'base': 'USD',
+                       'rates': RATES}, rates)
+        config.EXCHANGE_RATES_FILE = ratesfile
+        config.DEVEL = True
+        config.DEVEL_USERNAME = 'alice'
+        config.CACHE.clear()
+        core.global_currencies.clear()
+        init_db()
+        euro = core.Currency(isocode='EUR', name=u'Euro', symbol=u'€')
+        dollar = core.Currency(isocode='USD', name=u'US dollar', symbol=u'$')
+        db.session.add_all((euro, dollar))
+        db.session.add(core.User(username='alice', passhash='-',
+                                 preferred_currency=euro))
+        db.session.commit()
+        # Stored now rather than by a background thread on the first request
+        exchangerate.refresh()
+        exchangerate.loaded_history['history'] = None
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        config.CACHE.clear()
+        shutil.rmtree(self.directory)
+
+    def request(self, method, url, data=None, status=200):
+        """Send a request and return its decoded JSON response"""
+        response = self.client.open(url, method=method, data=data)
+        self.assertEqual(response.status_code, status, response.data)
+        return json.loads(response.data)
+
+    def get(self, url, status=200):
+        return self.request('GET', url, status=status)
+
+    def post(self, url, status=200, **data):
+        return self.request('POST', url, data, status)
@@ -0,0 +1,47 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from ospfm.cache import LRUCache, key_namespace
+
+
+class KeyNamespaceTestCase(unittest.TestCase):
+
+    def test_namespaces(self):
+        for key, namespace in (
+            (u'usercurrencies-alice', 'usercurrencies'),
+            (u'usercurrencies-bob-smith', 'usercurrencies'),
+            (u'currenciesversion-alice', 'currenciesversion'),
+            (u'categorybalance-12-3-4-5-2013-01-15', 'categorybalance'),
+            ('open-exchange-rates', 'open-exchange-rates'),
+            ('127.0.0.1-alice-authfails', 'authfails'),
+            ('127.0.0.1---0123456789abcdef', 'apikey'),
+            ('unknown-key', 'other')
+        ):
+            self.assertEqual(key_namespace(key), namespace)
+
+    def test_username_keys_statistics(self):
+        cache = LRUCache()
+        for username in (u'alice', u'bob', u'carol'):
+            cache.get(u'usercurrencies-{0}'.format(username))
+            cache.set(u'usercurrencies-{0}'.format(username), ({}, ()))
+            cache.get(u'usercurrencies-{0}'.format(username))
+        namespaces = cache.stats()['namespaces']
+        self.assertEqual(namespaces.keys(), ['usercurrencies'])
+        self.assertEqual(namespaces['usercurrencies']['hits'], 3)
+        self.assertEqual(namespaces['usercurrencies']['misses'], 3)
@@ -0,0 +1,135 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import calendar, datetime, json
+from decimal import Decimal
+
+from ospfm.core import exchangerate
+from ospfm.transaction import models
+from tests import OspfmTestCase
+
+
+class CategoryDailyBalanceTestCase(OspfmTestCase):
+
+    def daily_balances(self):
+        return dict([
+            ((b.category_id, b.day), b.amount)
+            for b in models.CategoryDailyBalance.query
+        ])
+
+    def test_categorized_transaction(self):
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(1)
+        food = self.post('/categories', name='Food', currency='EUR')
+        food = food['response']['id']
+        transaction = self.post('/transactions',
+            description='Groceries', currency='EUR', amount='-12.5',
+            date=today.isoformat(),
+            categories=json.dumps([{'category': food,
+                                    'transaction_amount': '-12.5',
+                                    'category_amount': '-12.5'}])
+        )['response']
+        self.assertEqual(self.daily_balances(),
+                         {(food, today): Decimal('-12.5')})
+
+        # Moving the transaction moves its daily balance
+        self.post('/transactions/{0}'.format(transaction['id']),
+                  date=yesterday.isoformat())
+        self.assertEqual(self.daily_balances(),
+                         {(food, yesterday): Decimal('-12.5')})
+
+        # Deleting the transaction deletes its daily balance
+        self.request('DELETE', '/transactions/{0}'.format(transaction['id']))
+        self.assertEqual(self.daily_balances(), {})
+
+    def test_removed_split(self):
+        today = datetime.date.today()
+        food = self.post('/categories', name='Food', currency='EUR')
+        food = food['response']['id']
+        home = self.post('/categories', name='Home', currency='EUR')
+        home = home['response']['id']
+        transaction = self.post('/transactions',
+            description='Supermarket', currency='EUR', amount='-30',
+            date=today.isoformat(),
+            categories=json.dumps([
+                {'category': food, 'transaction_amount': '-20',
+                 'category_amount': '-20'},
+                {'category': home, 'transaction_amount': '-10',
+                 'category_amount': '-10'}
+            ])
+        )['response']
+        self.post('/transactions/{0}'.format(transaction['id']),
+            categories=json.dumps([
+                {'category': food, 'transaction_amount': '-20',
+                 'category_amount': '-20'}
+            ])
+        )
+        self.assertEqual(self.daily_balances(),
+                         {(food, today): Decimal('-20')})
+
+    def test_other_days_kept(self):
+        # Recalculating several categories on several days keeps the other
+        # transactions of these categories and days
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(1)
+        food = self.post('/categories', name='Food', currency='EUR')
+        food = food['response']['id']
+        home = self.post('/categories', name='Home', currency='EUR')
+        home = home['response']['id']
+        for category, day, amount in ((food, yesterday, '-5'),
+                                      (home, today, '-7'),
+                                      (food, today, '-3')):
+            transaction = self.post('/transactions',
+                description='Shop', currency='EUR', amount=amount,
+                date=day.isoformat(),
+                categories=json.dumps([{'category': category,
+                                        'transaction_amount': amount,
+                                        'category_amount': amount}])
+            )['response']
+        self.post('/transactions/{0}'.format(transaction['id']),
+            date=yesterday.isoformat(),
+            categories=json.dumps([{'category': home,
+                                    'transaction_amount': '-3',
+                                    'category_amount': '-3'}])
+        )
+        self.assertEqual(self.daily_balances(), {
+            (food, yesterday): Decimal('-5'),
+            (home, today): Decimal('-7'),
+            (home, yesterday): Decimal('-3')
+        })
+
+    def test_historical_rates(self):
+        day = datetime.date.today() - datetime.timedelta(10)
+        timestamp = calendar.timegm(day.timetuple()) + 12 * 3600
+        exchangerate.store(timestamp, 'USD', {'USD': 1, 'EUR': 0.5})
+        travel = self.post('/categories', name='Travel',
+                           currency='EUR')['response']['id']
+        abroad = self.post('/categories', name='Abroad', currency='USD',
+                           parent=travel)['response']['id']
+        self.post('/transactions',
+            description='Hotel', currency='USD', amount='-10',
+            date=day.isoformat(),
+            categories=json.dumps([{'category': abroad,
+                                    'transaction_amount': '-10',
+                                    'category_amount': '-10'}])
+        )
+        category = self.get('/categories')['response'][0]
+        self.assertEqual(category['id'], travel)
+        # Converted at the rate of the transaction day, not today's one
+        self.assertEqual(Decimal(str(category['30days'])), Decimal('-5'))
+        self.assertEqual(Decimal(str(category['children'][0]['30days'])),
+                         Decimal('-10'))
@@ -0,0 +1,46 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+from decimal import Decimal
+from StringIO import StringIO
+
+from tests import OspfmTestCase
+
+
+class ImportTestCase(OspfmTestCase):
+
+    def test_categories_balances(self):
+        account = self.post('/accounts', name='Checking', currency='EUR',
+                            start_balance='0')['response']['id']
+        food = self.post('/categories', name='Food',
+                         currency='EUR')['response']['id']
+        # Cache the balance before the import
+        self.assertEqual(self.get('/categories')['response'][0]['year'], 0)
+        today = datetime.date.today().isoformat()
+        csv = 'date,description,amount\n{0},Groceries,-12.50\n' \
+              '{0},Bakery,-3.25\n'.format(today)
+        response = self.request('POST', '/transactions/import', {
+            'format': 'csv',
+            'account': str(account),
+            'category': str(food),
+            'file': (StringIO(csv), 'transactions.csv')
+        })
+        self.assertEqual(response['response'], {'imported': 2})
+        category = self.get('/categories')['response'][0]
+        self.assertEqual(category['id'], food)
+        self.assertEqual(Decimal(str(category['year'])), Decimal('-15.75'))
@@ -0,0 +1,50 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from decimal import Decimal
+from StringIO import StringIO
+
+from ospfm.transaction.importer import ImportFormatError, parse_amount, \
+                                      parse_csv
+
+
+class ParseAmountTestCase(unittest.TestCase):
+
+    def test_separators(self):
+        for value, amount in (
+            ('12.50', '12.50'), ('12,50', '12.50'), ('-12,5', '-12.5'),
+            ('1,234.56', '1234.56'), ('1.234,56', '1234.56'),
+            ('1 234,56', '1234.56'), ('1,234,567', '1234567'),
+            ('-.50', '-0.50')
+        ):
+            self.assertEqual(parse_amount(value, 1), Decimal(amount))
+
+    def test_rejected(self):
+        for value in ('1,234', '1.234', '1.5.3', '1,234.567.8', '12,', '-',
+                      'abc'):
+            self.assertRaises(ImportFormatError, parse_amount, value, 1)
+
+
+class ParseCsvTestCase(unittest.TestCase):
+
+    def test_latin1(self):
+        stream = StringIO('date,description,amount\n'
+                          '2013-01-15,Caf\xe9,-3.50\n')
+        transactions = list(parse_csv(stream))
+        self.assertEqual(transactions[0]['description'], u'Caf\ufffd')
+        self.assertEqual(transactions[0]['amount'], Decimal('-3.50'))
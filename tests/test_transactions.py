@@ -0,0 +1,134 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime, json
+from decimal import Decimal
+
+from ospfm import db
+from ospfm.core import models as core
+from tests import OspfmTestCase
+
+
+def amount(value):
+    return Decimal(str(value))
+
+
+class TransactionUpdateTestCase(OspfmTestCase):
+
+    def test_removed_splits(self):
+        checking = self.post('/accounts', name='Checking', currency='EUR',
+                             start_balance='100')['response']['id']
+        savings = self.post('/accounts', name='Savings', currency='EUR',
+                            start_balance='50')['response']['id']
+        food = self.post('/categories', name='Food',
+                         currency='EUR')['response']['id']
+        home = self.post('/categories', name='Home',
+                         currency='EUR')['response']['id']
+        transaction = self.post('/transactions',
+            description='Supermarket', currency='EUR', amount='-30',
+            date=datetime.date.today().isoformat(),
+            accounts=json.dumps([
+                {'account': checking, 'amount': '-20'},
+                {'account': savings, 'amount': '-10'}
+            ]),
+            categories=json.dumps([
+                {'category': food, 'transaction_amount': '-20',
+                 'category_amount': '-20'},
+                {'category': home, 'transaction_amount': '-10',
+                 'category_amount': '-10'}
+            ])
+        )['response']
+
+        # Remove one account split and one category split
+        self.post('/transactions/{0}'.format(transaction['id']),
+            accounts=json.dumps([{'account': checking, 'amount': '-20'}]),
+            categories=json.dumps([
+                {'category': food, 'transaction_amount': '-20',
+                 'category_amount': '-20'}
+            ])
+        )
+
+        accounts = self.get('/accounts')['response']
+        balances = dict([(a['id'], amount(a['balance']))
+                         for a in accounts['accounts']])
+        self.assertEqual(balances, {checking: 80, savings: 50})
+        self.assertEqual(amount(accounts['total']['balance']), 130)
+
+        categories = dict([(c['id'], amount(c['year']))
+                           for c in self.get('/categories')['response']])
+        self.assertEqual(categories, {food: -20, home: 0})
+
+        # The stored total balance follows the removal too
+        db.session.remove()
+        self.assertEqual(core.User.query.get('alice').total_balance, 130)
+
+
+class TransactionFilterTestCase(OspfmTestCase):
+
+    def test_invalid_cursor(self):
+        for cursor in ('invalid', 'MjAxMi0xMC0xNQ', '12345'):
+            self.get('/transactions/filter?after={0}'.format(cursor), 400)
+
+    def test_search_pages(self):
+        today = datetime.date.today().isoformat()
+        ids = []
+        for description in ('Coffee', 'Coffee and coffee beans',
+                            'Coffee shop: coffee, coffee'):
+            ids.append(self.post('/transactions', description=description,
+                                 currency='EUR', amount='-3',
+                                 date=today)['response']['id'])
+        self.post('/transactions', description='Tea', currency='EUR',
+                  amount='-2', date=today)
+        # From the best match
+        found = []
+        page = self.get('/transactions/filter?search=coffee&limit=1')
+        while page['response']:
+            found.extend([t['id'] for t in page['response']])
+            page = self.get('/transactions/filter?search=coffee&limit=1'
+                            '&after={0}'.format(page['next']))
+        self.assertEqual(found, list(reversed(ids)))
+        # A listing cursor cannot be used in a search
+        cursor = self.get('/transactions/filter?limit=1')['next']
+        self.get('/transactions/filter?search=coffee&after={0}'.format(cursor),
+                 400)
+
+    def test_category_pages(self):
+        today = datetime.date.today().isoformat()
+        food = self.post('/categories', name='Food',
+                         currency='EUR')['response']['id']
+        fruits = self.post('/categories', name='Fruits', currency='EUR',
+                           parent=food)['response']['id']
+        ids = []
+        for index in range(4):
+            # Split in the category and its child
+            ids.append(self.post('/transactions', description='Market',
+                currency='EUR', amount='-10', date=today,
+                categories=json.dumps([
+                    {'category': food, 'transaction_amount': '-6',
+                     'category_amount': '-6'},
+                    {'category': fruits, 'transaction_amount': '-4',
+                     'category_amount': '-4'}
+                ])
+            )['response']['id'])
+        found = []
+        url = '/transactions/filter?category={0}&limit=2'.format(food)
+        page = self.get(url)
+        while page['response']:
+            self.assertEqual(len(page['response']), 2)
+            found.extend([t['id'] for t in page['response']])
+            page = self.get('{0}&after={1}'.format(url, page['next']))
+        self.assertEqual(found, list(reversed(ids)))